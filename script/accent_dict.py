@@ -0,0 +1,227 @@
+"""
+手修正済みのrohan4600_memo.txtから作る、アクセント句の辞書。
+ポーズで区切られた区間ごとに、連続するアクセント句の並びを音素列（normalize_phonesで揃えたもの）をキーにして、
+アクセント記号付きの読みと音素列（無声化込み）を引けるようにする。
+音素の遷移はCSR形式の配列のトライ木で持ち、最長一致で引く。
+  python script/accent_dict.py  # rohan4600_accent_dict.tsvを作る
+"""
+
+import argparse
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from data import pause_list
+from phoneme import unvoiced2voiced
+
+default_dict_path = Path("rohan4600_accent_dict.tsv")
+
+
+# 読みから作った音素列は「おう」「えい」のままだが、OpenJTalkを通した音素列では長音になっている
+long_vowels = {("o", "u"): "o", ("e", "i"): "e"}
+
+
+def normalize_phones(phones: Sequence[str]):
+    # 辞書のキーと検索する音素列を同じ形にする。無声化を無視し、「おう」「えい」を長音にする
+    normalized = [unvoiced2voiced.get(phone, phone) for phone in phones]
+    for i in range(1, len(normalized)):
+        normalized[i] = long_vowels.get(
+            (normalized[i - 1], normalized[i]), normalized[i]
+        )
+    return normalized
+
+
+@dataclass
+class Entry:
+    phones: List[str]  # 無声化込みの音素列
+    memo: str  # 「|」区切りのアクセント記号付きの読み
+    count: int
+
+    @property
+    def key(self):
+        return " ".join(normalize_phones(self.phones))
+
+
+def split_chunks(phones: Sequence[str]):
+    # ポーズで区切られた区間の(開始, 終了)
+    chunks: List[Tuple[int, int]] = []
+    start = 0
+    for i, phone in enumerate(list(phones) + ["pau"]):
+        if phone in pause_list:
+            if i > start:
+                chunks.append((start, i))
+            start = i + 1
+    return chunks
+
+
+def collect_entries(memo_path: Path, phonemes_path: Path):
+    from accent_post import yomi_to_phones
+
+    memo_lines = memo_path.read_text().strip().split("\n\n")
+    phoneme_lines = phonemes_path.read_text().strip().splitlines()
+    assert len(memo_lines) == len(phoneme_lines)
+
+    counts: Dict[str, Counter[Tuple[str, str]]] = defaultdict(Counter)
+    for memo_line, phoneme_line in zip(memo_lines, phoneme_lines):
+        memo = memo_line.strip().split("\n")[1]
+        phones = phoneme_line.split()[1:-1]
+
+        # アクセント句ごとの音素の範囲を求め、ポーズで区間に分ける
+        chunks: List[List[Tuple[str, int, int]]] = [[]]
+        position = 0
+        for phrase in memo.split("|"):
+            length = len(yomi_to_phones(phrase))
+            if phrase == "、":
+                chunks.append([])
+            else:
+                chunks[-1].append((phrase, position, position + length))
+            position += length
+        assert position == len(phones), memo
+
+        for chunk in chunks:
+            # 手修正されていないアクセント句を含む区間は使わない
+            if any("?" in phrase for phrase, _, _ in chunk):
+                continue
+            for i in range(len(chunk)):
+                for j in range(i + 1, len(chunk) + 1):
+                    s, e = chunk[i][1], chunk[j - 1][2]
+                    value = (
+                        " ".join(phones[s:e]),
+                        "|".join(phrase for phrase, _, _ in chunk[i:j]),
+                    )
+                    counts[" ".join(normalize_phones(phones[s:e]))][value] += 1
+
+    # 同じ音素列で読みが違う場合は多い方を使う
+    entries: List[Entry] = []
+    for key in sorted(counts):
+        (phones_text, memo), count = counts[key].most_common(1)[0]
+        entries.append(Entry(phones_text.split(), memo, count))
+    return entries
+
+
+def write_entries(path: Path, entries: List[Entry]):
+    path.write_text(
+        "".join(
+            f"{' '.join(entry.phones)}\t{entry.memo}\t{entry.count}\n"
+            for entry in entries
+        )
+    )
+
+
+def read_entries(path: Path):
+    entries: List[Entry] = []
+    for line in path.read_text().splitlines():
+        phones, memo, count = line.split("\t")
+        entries.append(Entry(phones.split(), memo, int(count)))
+    return entries
+
+
+class AccentDict:
+    """
+    音素列のトライ木。ノードiの子はlabels[offsets[i]:offsets[i + 1]]に音素ID順に並び、
+    values[i]はノードiで終わるエントリの番号（無ければ-1）。
+    """
+
+    def __init__(self, entries: List[Entry]):
+        self.entries = entries
+        self.phone_ids: Dict[str, int] = {}
+
+        nodes: List[Dict[int, int]] = [{}]
+        node_values = [-1]
+        for index, entry in enumerate(entries):
+            node = 0
+            for phone in entry.key.split():
+                phone_id = self.phone_ids.setdefault(phone, len(self.phone_ids))
+                if phone_id not in nodes[node]:
+                    nodes[node][phone_id] = len(nodes)
+                    nodes.append({})
+                    node_values.append(-1)
+                node = nodes[node][phone_id]
+            node_values[node] = index
+
+        self.offsets = array("i", [0])
+        self.labels = array("i")
+        self.children = array("i")
+        for children in nodes:
+            for phone_id in sorted(children):
+                self.labels.append(phone_id)
+                self.children.append(children[phone_id])
+            self.offsets.append(len(self.labels))
+        self.values = array("i", node_values)
+
+    def _child(self, node: int, phone: str):
+        phone_id = self.phone_ids.get(phone)
+        if phone_id is None:
+            return -1
+        lo, hi = self.offsets[node], self.offsets[node + 1]
+        i = bisect_left(self.labels, phone_id, lo, hi)
+        if i == hi or self.labels[i] != phone_id:
+            return -1
+        return self.children[i]
+
+    def longest_match(
+        self, phones: Sequence[str], start: int, end: int, min_phones: int = 0
+    ):
+        # phones[start:end]の先頭から一致する、min_phones音素以上で最も長いエントリの(終了位置, エントリ)
+        found: Optional[Tuple[int, Entry]] = None
+        node = 0
+        for i in range(start, end):
+            node = self._child(node, phones[i])
+            if node < 0:
+                break
+            if self.values[node] >= 0 and i + 1 - start >= min_phones:
+                found = (i + 1, self.entries[self.values[node]])
+        return found
+
+    def match_chunk(
+        self, phones: Sequence[str], start: int, end: int, min_phones: int = 6
+    ):
+        # 区間全体を最長一致で覆えればエントリの並び、覆えなければNone
+        # 短いアクセント句をつなぎ合わせると区切りを誤りやすいので、
+        # min_phones音素未満のエントリは区間全体と一致するときだけ使う
+        found = self.longest_match(phones, start, end)
+        if found is not None and found[0] == end:
+            return [found[1]]
+
+        matched: List[Entry] = []
+        while start < end:
+            found = self.longest_match(phones, start, end, min_phones=min_phones)
+            if found is None:
+                return None
+            start, entry = found
+            matched.append(entry)
+        return matched
+
+    def __len__(self):
+        return len(self.entries)
+
+
+@lru_cache(maxsize=None)
+def load_accent_dict(path: Path):
+    return AccentDict(read_entries(path))
+
+
+def build(memo_path: Path, phonemes_path: Path, output_path: Path):
+    entries = collect_entries(memo_path=memo_path, phonemes_path=phonemes_path)
+    write_entries(output_path, entries)
+
+    accent_dict = AccentDict(entries)
+    print(
+        f"{len(entries)} entries, {len(accent_dict.offsets) - 1} nodes, "
+        f"{output_path.stat().st_size / 1e6:.1f} MB"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--memo_path", type=Path, default=Path("rohan4600_memo.txt"))
+    parser.add_argument(
+        "--phonemes_path", type=Path, default=Path("rohan4600_phonemes.txt")
+    )
+    parser.add_argument("--output_path", type=Path, default=default_dict_path)
+    args = parser.parse_args()
+    build(**vars(args))
@@ -1,9 +1,22 @@
+import argparse
+import os
 import re
+import time
+import traceback
 from difflib import SequenceMatcher
+from functools import lru_cache
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 from data import conso_list, other_list, pause_list, vowel_list, yomi2mora
+from length_index import IndexRow, create_index_row, load_index, write_index
+from mora import to_mora_features
+
+
+# 読み→空白区切りの音素の置換表
+yomi2mora_text = {
+    yomi: " " + " ".join(phones) + " " for yomi, phones in yomi2mora.items()
+}
 
 
 def yomi_to_phones(text: str):
@@ -11,8 +24,8 @@ def yomi_to_phones(text: str):
     text = text.replace("ふゅ", "ひゅ").replace("しぃ", "しい")
 
     text = text.replace("'", "").replace("|", "")
-    for yomi, phones in yomi2mora.items():
-        text = text.replace(yomi, " " + " ".join(phones) + " ")
+    for yomi, mora_text in yomi2mora_text.items():
+        text = text.replace(yomi, mora_text)
     text = re.sub(r"\s+", " ", text)
     return text.split()
 
@@ -58,57 +71,104 @@ def modify_phonemes(yomi_phones: list[str], ojt_phones: list[str]):
     return new_phones
 
 
-def yomi_to_accents(text: str):
-    for yomi, phones in yomi2mora.items():
-        text = text.replace(yomi, " " + " ".join(phones) + " ")
-    text = text.replace("|", " | ").replace("'", " ' ")
-    text = re.sub(r"\s+", " ", text)
+@lru_cache(maxsize=2**16)
+def phrase_phones(phrase: str):
+    # 同じアクセント句は何度も出てくるのでキャッシュする
+    return tuple(yomi_to_phones(phrase))
+
+
+@lru_cache(maxsize=2**16)
+def phrase_accents(phrase: str):
+    # アクセント句ごとに4種類のアクセントラベルを求める。音素列だけ・アクセントだけの呼び出しで
+    # もう一方を計算しないよう、phrase_phonesとは別にキャッシュする
+    text = phrase
+    for yomi, mora_text in yomi2mora_text.items():
+        text = text.replace(yomi, mora_text)
+    tokens = text.replace("'", " ' ").split()
+
+    if tokens == ["pau"]:
+        return ("0",), ("0",), ("0",), ("0",)
+
+    assert sum(p == "'" for p in tokens) == 1
+
+    moras: list[Union[tuple[str], tuple[str, str]]] = []
+    for prev, cent in zip([""] + tokens[:-1], tokens):
+        if cent not in conso_list:
+            if prev in conso_list:
+                moras += [(prev, cent)]
+            else:
+                moras += [(cent,)]
 
-    phrases = [t.strip().split() for t in text.split("|")]
+    pos = next(filter(lambda x: x[1] == ("'",), enumerate(moras)))[0]
+    moras = list(filter(lambda x: x != ("'",), moras))
+
+    mora_phrase_starts = ["1"] + ["0"] * (len(moras) - 1)
+    mora_phrase_ends = ["0"] * (len(moras) - 1) + ["1"]
+
+    if pos == 1:
+        mora_starts = ["1"] + ["0"] * (len(moras) - 1)
+    else:
+        mora_starts = ["0", "1"] + ["0"] * (len(moras) - 2)
+
+    mora_ends = ["0"] * (pos - 1) + ["1"] + ["0"] * (len(moras) - pos)
 
     starts: list[str] = []
     ends: list[str] = []
     phrase_starts: list[str] = []
     phrase_ends: list[str] = []
 
-    for phrase in phrases:
-        if phrase == ["pau"]:
-            starts += ["0"]
-            ends += ["0"]
-            phrase_starts += ["0"]
-            phrase_ends += ["0"]
-            continue
+    for mora_start, mora_end, mora_phrase_start, mora_phrase_end, mora in zip(
+        mora_starts, mora_ends, mora_phrase_starts, mora_phrase_ends, moras
+    ):
+        starts += [mora_start] * len(mora)
+        ends += [mora_end] * len(mora)
+        phrase_starts += [mora_phrase_start] * len(mora)
+        phrase_ends += [mora_phrase_end] * len(mora)
 
-        assert sum(p == "'" for p in phrase) == 1
+    return (
+        tuple(starts),
+        tuple(ends),
+        tuple(phrase_starts),
+        tuple(phrase_ends),
+    )
 
-        moras: list[Union[tuple[str], tuple[str, str]]] = []
-        for prev, cent in zip([""] + phrase[:-1], phrase):
-            if cent not in conso_list:
-                if prev in conso_list:
-                    moras += [(prev, cent)]
-                else:
-                    moras += [(cent,)]
 
-        pos = next(filter(lambda x: x[1] == ("'",), enumerate(moras)))[0]
-        moras = list(filter(lambda x: x != ("'",), moras))
+def yomi_to_phones_and_accents(text: str):
+    phones: list[str] = []
+    starts: list[str] = []
+    ends: list[str] = []
+    phrase_starts: list[str] = []
+    phrase_ends: list[str] = []
 
-        mora_phrase_starts = ["1"] + ["0"] * (len(moras) - 1)
-        mora_phrase_ends = ["0"] * (len(moras) - 1) + ["1"]
+    for phrase in text.split("|"):
+        s, e, ps, pe = phrase_accents(phrase)
+        phones += phrase_phones(phrase)
+        starts += s
+        ends += e
+        phrase_starts += ps
+        phrase_ends += pe
 
-        if pos == 1:
-            mora_starts = ["1"] + ["0"] * (len(moras) - 1)
-        else:
-            mora_starts = ["0", "1"] + ["0"] * (len(moras) - 2)
+    return (
+        phones,
+        starts,
+        ends,
+        phrase_starts,
+        phrase_ends,
+    )
 
-        mora_ends = ["0"] * (pos - 1) + ["1"] + ["0"] * (len(moras) - pos)
 
-        for mora_start, mora_end, mora_phrase_start, mora_phrase_end, mora in zip(
-            mora_starts, mora_ends, mora_phrase_starts, mora_phrase_ends, moras
-        ):
-            starts += [mora_start] * len(mora)
-            ends += [mora_end] * len(mora)
-            phrase_starts += [mora_phrase_start] * len(mora)
-            phrase_ends += [mora_phrase_end] * len(mora)
+def yomi_to_accents(text: str):
+    starts: list[str] = []
+    ends: list[str] = []
+    phrase_starts: list[str] = []
+    phrase_ends: list[str] = []
+
+    for phrase in text.split("|"):
+        s, e, ps, pe = phrase_accents(phrase)
+        starts += s
+        ends += e
+        phrase_starts += ps
+        phrase_ends += pe
 
     return (
         starts,
@@ -195,8 +255,65 @@ def accent_check(
     assert a == b
 
 
-def main():
-    phoneme_path = Path("rohan4600_phoneme.txt")
+def convert_row(phone_text: str, yomi: str):
+    """
+    1発話分の音素列とアクセント付きの読みから、前後の無音を含むアクセントラベルを作って検査する。
+    """
+    (
+        yomi_phones,
+        accent_starts,
+        accent_ends,
+        accent_phrase_starts,
+        accent_phrase_ends,
+    ) = yomi_to_phones_and_accents(yomi)
+
+    phones = ["sil"] + modify_phonemes(yomi_phones, phone_text.split()[1:-1]) + ["sil"]
+    assert phone_text.lower() == " ".join(phones).lower()
+
+    accent_starts = ["0"] + accent_starts + ["0"]
+    accent_ends = ["0"] + accent_ends + ["0"]
+    accent_phrase_starts = ["0"] + accent_phrase_starts + ["0"]
+    accent_phrase_ends = ["0"] + accent_phrase_ends + ["0"]
+
+    # print(phones)
+    # print(accent_starts)
+    # print(accent_ends)
+    # print(accent_phrase_starts)
+    # print(accent_phrase_ends)
+
+    accent_check(
+        phones=phones,
+        accent_starts=[bool(int(a)) for a in accent_starts],
+        accent_ends=[bool(int(a)) for a in accent_ends],
+        accent_phrase_starts=[bool(int(a)) for a in accent_phrase_starts],
+        accent_phrase_ends=[bool(int(a)) for a in accent_phrase_ends],
+    )
+    return accent_starts, accent_ends, accent_phrase_starts, accent_phrase_ends
+
+
+accent_names = [
+    "accent_starts",
+    "accent_ends",
+    "accent_phrase_starts",
+    "accent_phrase_ends",
+]
+
+mora_names = [
+    "moras",
+    "mora_offsets",
+    "mora_accent_starts",
+    "mora_accent_ends",
+    "mora_accent_phrase_starts",
+    "mora_accent_phrase_ends",
+]
+
+
+def main(mora: bool, profile_memory: bool, profile: Optional[Path]):
+    from profiling import Profiler
+
+    profiler = Profiler(memory=profile_memory, cpu_dir=profile)
+
+    phoneme_path = Path("rohan4600_phonemes.txt")
     modified_path = Path("rohan4600_memo.txt")
 
     accent_starts_path = Path("rohan4600_accent_starts.txt")
@@ -204,62 +321,260 @@ def main():
     accent_phrase_starts_path = Path("rohan4600_accent_phrase_starts.txt")
     accent_phrase_ends_path = Path("rohan4600_accent_phrase_ends.txt")
 
-    phone_text_list = phoneme_path.read_text().splitlines()
-    yomis = modified_path.read_text().splitlines()[1::3]
+    with profiler.stage("load"):
+        phone_text_list = phoneme_path.read_text().splitlines()
+        yomis = modified_path.read_text().splitlines()[1::3]
 
     accent_start_text = ""
     accent_end_text = ""
     accent_phrase_start_text = ""
     accent_phrase_end_text = ""
+    mora_texts = ["" for _ in mora_names]
+    index_rows: list[IndexRow] = []
 
     # phone_text_list = phone_text_list[:10]
     # yomis = yomis[:10]
-    for phone_text, yomi in zip(phone_text_list, yomis):
+    profiler.start("convert", utterances=len(yomis))
+    for i, (phone_text, yomi) in enumerate(zip(phone_text_list, yomis)):
         print(yomi)
 
-        phones = (
-            ["sil"]
-            + modify_phonemes(yomi_to_phones(yomi), phone_text.split()[1:-1])
-            + ["sil"]
-        )
-        assert phone_text.lower() == " ".join(phones).lower()
-
         (
             accent_starts,
             accent_ends,
             accent_phrase_starts,
             accent_phrase_ends,
-        ) = yomi_to_accents(yomi)
-
-        accent_starts = ["0"] + accent_starts + ["0"]
-        accent_ends = ["0"] + accent_ends + ["0"]
-        accent_phrase_starts = ["0"] + accent_phrase_starts + ["0"]
-        accent_phrase_ends = ["0"] + accent_phrase_ends + ["0"]
-
-        # print(phones)
-        # print(accent_starts)
-        # print(accent_ends)
-        # print(accent_phrase_starts)
-        # print(accent_phrase_ends)
-
-        accent_check(
-            phones=phones,
-            accent_starts=[bool(int(a)) for a in accent_starts],
-            accent_ends=[bool(int(a)) for a in accent_ends],
-            accent_phrase_starts=[bool(int(a)) for a in accent_phrase_starts],
-            accent_phrase_ends=[bool(int(a)) for a in accent_phrase_ends],
-        )
+        ) = convert_row(phone_text, yomi)
 
         accent_start_text += " ".join(accent_starts) + "\n"
         accent_end_text += " ".join(accent_ends) + "\n"
         accent_phrase_start_text += " ".join(accent_phrase_starts) + "\n"
         accent_phrase_end_text += " ".join(accent_phrase_ends) + "\n"
 
+        index_rows.append(
+            create_index_row(
+                f"rohan4600_{i + 1:04d}", phone_text.split(), accent_phrase_starts
+            )
+        )
+
+        if mora:
+            mora_features = to_mora_features(
+                phone_text.split(),
+                accent_starts,
+                accent_ends,
+                accent_phrase_starts,
+                accent_phrase_ends,
+            )
+            for j, feature in enumerate(mora_features):
+                mora_texts[j] += " ".join(feature) + "\n"
+    profiler.stop()
+
+    profiler.start("write")
     accent_starts_path.write_text(accent_start_text)
     accent_ends_path.write_text(accent_end_text)
     accent_phrase_starts_path.write_text(accent_phrase_start_text)
     accent_phrase_ends_path.write_text(accent_phrase_end_text)
 
+    write_index(Path("rohan4600_index.tsv"), index_rows)
+
+    if mora:
+        for name, text in zip(mora_names, mora_texts):
+            Path(f"rohan4600_{name}.txt").write_text(text)
+    profiler.stop()
+
+    profiler.report()
+
+
+def _read_rows(phoneme_path: Path, memo_path: Path, mora: bool):
+    # 全体を読み込まずに、1発話ずつ音素列とアクセント付きの読みを返す
+    with phoneme_path.open() as phoneme_file, memo_path.open() as memo_file:
+        yomis = (line for i, line in enumerate(memo_file) if i % 3 == 1)
+        for i, (phone_text, yomi) in enumerate(zip(phoneme_file, yomis)):
+            yield i, phone_text.rstrip("\n"), yomi.rstrip("\n"), mora
+
+
+def _convert_task(args: tuple[int, str, str, bool]):
+    i, phone_text, yomi, mora = args
+    name = f"rohan4600_{i + 1:04d}"
+    try:
+        row = convert_row(phone_text, yomi)
+    except Exception as e:
+        return None, None, _error_message(name, yomi, e)
+
+    features = list(row)
+    if mora:
+        features += to_mora_features(phone_text.split(), *row)
+    lines = [" ".join(feature) + "\n" for feature in features]
+    return lines, create_index_row(name, phone_text.split(), row[2]), None
+
+
+def stream(
+    mora: bool,
+    workers: int,
+    chunksize: int,
+    profile_memory: bool,
+    profile: Optional[Path],
+):
+    """
+    mainと同じ出力を、発話を少しずつ読みながらworkers個のプロセスで作る。
+    結果は発話の順に一時ファイルへ書き足していき、全て成功したら置き換える。
+    失敗した発話があればまとめて表示し、出力は元のまま残す。
+    """
+    import multiprocessing
+
+    from tqdm import tqdm
+
+    from profiling import Profiler
+
+    profiler = Profiler(memory=profile_memory, cpu_dir=profile)
+
+    output_names = accent_names + (mora_names if mora else [])
+    output_paths = [Path(f"rohan4600_{name}.txt") for name in output_names]
+    temp_paths = [path.with_name(path.name + ".tmp") for path in output_paths]
+
+    index_rows: list[IndexRow] = []
+    errors: list[str] = []
+
+    profiler.start("convert")
+    files = [path.open("w") for path in temp_paths]
+    try:
+        with multiprocessing.Pool(processes=workers, **profiler.pool_kwargs()) as pool:
+            it = pool.imap(
+                _convert_task,
+                _read_rows(
+                    Path("rohan4600_phonemes.txt"), Path("rohan4600_memo.txt"), mora
+                ),
+                chunksize=chunksize,
+            )
+            for lines, index_row, error in tqdm(it, unit="utterance"):
+                if error is not None:
+                    errors.append(error)
+                    continue
+                for f, line in zip(files, lines):
+                    f.write(line)
+                index_rows.append(index_row)
+
+            pool.close()
+            pool.join()
+    finally:
+        for f in files:
+            f.close()
+    profiler.stop(utterances=len(index_rows) + len(errors))
+
+    if len(errors) > 0:
+        for temp_path in temp_paths:
+            temp_path.unlink()
+        print("\n".join(errors))
+        raise SystemExit(f"{len(errors)} failed")
+
+    for temp_path, path in zip(temp_paths, output_paths):
+        os.replace(temp_path, path)
+    write_index(Path("rohan4600_index.tsv"), index_rows)
+
+    profiler.report()
+
+
+def _replace_text(path: Path, text: str):
+    # 書き込み途中のファイルが読まれないように、一時ファイルから置き換える
+    temp_path = path.with_name(path.name + ".tmp")
+    temp_path.write_text(text)
+    os.replace(temp_path, path)
+
+
+def _error_message(name: str, yomi: str, e: Exception):
+    frame = traceback.extract_tb(e.__traceback__)[-1]
+    message = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+    return f"{name}: {yomi}\n    {message} at line {frame.lineno}: {frame.line}"
+
+
+def watch(mora: bool, interval: float):
+    """
+    rohan4600_memo.txtの保存を監視し、読みが変わった発話の行だけを計算し直して出力を書き換える。
+    失敗した発話は古い行のまま残し、直るまで保存のたびにエラーを表示する。
+    """
+    phoneme_path = Path("rohan4600_phonemes.txt")
+    modified_path = Path("rohan4600_memo.txt")
+    index_path = Path("rohan4600_index.tsv")
+
+    output_names = accent_names + (mora_names if mora else [])
+    output_paths = [Path(f"rohan4600_{name}.txt") for name in output_names]
+
+    phone_text_list = phoneme_path.read_text().splitlines()
+    yomis = modified_path.read_text().splitlines()[1::3]
+    output_lines = [path.read_text().splitlines() for path in output_paths]
+    index_rows = load_index(index_path)
+    for path, lines in zip(output_paths + [index_path], output_lines + [index_rows]):
+        assert len(lines) == len(yomis), f"{path} is outdated. run without --watch"
+
+    mtime = modified_path.stat().st_mtime_ns
+    print("watching", modified_path)
+    while True:
+        time.sleep(interval)
+        new_mtime = modified_path.stat().st_mtime_ns
+        if new_mtime == mtime:
+            continue
+        mtime = new_mtime
+
+        t = time.perf_counter()
+        new_yomis = modified_path.read_text().splitlines()[1::3]
+        if len(new_yomis) != len(yomis):
+            print(f"number of entries changed: {len(yomis)} -> {len(new_yomis)}")
+            continue
+
+        changed = [i for i, (a, b) in enumerate(zip(yomis, new_yomis)) if a != b]
+        updated: list[int] = []
+        for i in changed:
+            name = f"rohan4600_{i + 1:04d}"
+            phone_text = phone_text_list[i]
+            try:
+                row = convert_row(phone_text, new_yomis[i])
+            except Exception as e:
+                print(_error_message(name, new_yomis[i], e))
+                continue
+
+            features = list(row)
+            if mora:
+                features += to_mora_features(phone_text.split(), *row)
+            for lines, feature in zip(output_lines, features):
+                lines[i] = " ".join(feature)
+            index_rows[i] = create_index_row(name, phone_text.split(), row[2])
+
+            yomis[i] = new_yomis[i]
+            updated.append(i)
+
+        if len(updated) > 0:
+            for path, lines in zip(output_paths, output_lines):
+                _replace_text(path, "".join(line + "\n" for line in lines))
+            write_index(index_path, index_rows)
+
+        print(
+            f"{len(changed)} changed, {len(updated)} updated, "
+            f"{len(changed) - len(updated)} failed ({time.perf_counter() - t:.2f}s)"
+        )
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mora", action="store_true")
+    parser.add_argument("--profile-memory", action="store_true")
+    parser.add_argument("--profile", type=Path, nargs="?", const=Path("profile"))
+    parser.add_argument("--watch", action="store_true")
+    parser.add_argument("--interval", type=float, default=0.5)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--chunksize", type=int, default=64)
+    args = parser.parse_args()
+    if args.watch:
+        watch(mora=args.mora, interval=args.interval)
+    elif args.workers is not None:
+        stream(
+            mora=args.mora,
+            workers=args.workers,
+            chunksize=args.chunksize,
+            profile_memory=args.profile_memory,
+            profile=args.profile,
+        )
+    else:
+        main(
+            mora=args.mora,
+            profile_memory=args.profile_memory,
+            profile=args.profile,
+        )
@@ -0,0 +1,287 @@
+"""
+テキストの出力をまとめて、ブロックごとに独立して圧縮した1つのファイルにする。
+ファイルは発話ごとのレコードに分け（1行に1発話のファイルは行ごと、rohan4600_memo.txtは空行区切りごと、
+each_memo*.txtは6行ごと、話者ディレクトリの中はファイルごと）、
+レコードを順にblock_sizeバイトずつのブロックに詰めてzlibで圧縮する。
+末尾のインデックスにレコードの位置を書くので、読むときは必要なレコードを含むブロックだけ展開すればよい。
+パスは--root（既定はカレントディレクトリ）からの相対パスで保存し、その外のパスは扱わない。
+  export: ファイルやディレクトリをまとめる
+  import: 元のファイルに戻す
+  cat: 1つのレコードを表示する
+"""
+
+import argparse
+import json
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path, PurePosixPath
+from typing import Deque, Dict, List, Optional, Tuple
+
+magic = b"RHBLK1\n"
+footer_format = "<QQ"  # インデックスの位置と長さ
+
+# each.pyのメモは1発話6行で、空行では区切られていない
+each_memo_lines = 6
+
+
+def split_records(path: Path, data: bytes):
+    # つなげると元に戻るように区切り文字は残す
+    if path.name.startswith("each_memo"):
+        lines = data.splitlines(keepends=True)
+        return [
+            b"".join(lines[i : i + each_memo_lines])
+            for i in range(0, len(lines), each_memo_lines)
+        ]
+    if path.name.endswith("memo.txt"):
+        records = [record + b"\n\n" for record in data.split(b"\n\n")]
+        records[-1] = records[-1][:-2]
+        return [record for record in records if len(record) > 0]
+    return data.splitlines(keepends=True)
+
+
+def check_path(path: str):
+    # 書き出す先がrootの外にならないよう、絶対パスや..を含むパスは拒否する
+    parts = PurePosixPath(path).parts
+    if PurePosixPath(path).is_absolute() or ".." in parts or len(parts) == 0:
+        raise ValueError(f"{path} is not a relative path inside the root")
+    return path
+
+
+def relative_path(path: Path, root: Path):
+    try:
+        relative = path.resolve().relative_to(root.resolve())
+    except ValueError:
+        raise ValueError(f"{path} is outside {root}") from None
+    return check_path(relative.as_posix())
+
+
+def collect_files(paths: List[Path], root: Path):
+    # ディレクトリの中は発話ごとにまとまるよう、ファイル名・ディレクトリの順に並べる
+    files: List[Tuple[str, bool]] = []  # rootからのパスと、行ごとに分けるかどうか
+    for path in paths:
+        if path.is_dir():
+            names = sorted(
+                (p for p in path.rglob("*") if p.is_file()),
+                key=lambda p: (p.name, p.parent.as_posix()),
+            )
+            files += [(relative_path(p, root), False) for p in names]
+        else:
+            files.append((relative_path(path, root), True))
+    return files
+
+
+class BlockWriter:
+    """
+    addでレコードを詰め、block_sizeを超えたブロックを裏のスレッドで圧縮する。
+    zlibは圧縮中にGILを解放するので、スレッドでも並列に圧縮できる。
+    圧縮待ちがmax_pendingブロックを超えたら、先頭のブロックを書き出すまで待つ。
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        block_size: int = 1 << 16,
+        level: int = 9,
+        num_workers: Optional[int] = None,
+        max_pending: int = 64,
+    ):
+        self.path = path
+        self.tmp_path = path.with_name(path.name + ".tmp")
+        self.file = self.tmp_path.open("wb")
+        self.file.write(magic)
+
+        self.block_size = block_size
+        self.level = level
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=num_workers or os.cpu_count())
+        self.pending: Deque[Tuple[Future, int, int]] = deque()
+
+        self.buffer = bytearray()
+        # ブロックごとの位置、圧縮後と元の長さ、crc32
+        self.blocks: List[Tuple[int, int, int, int]] = []
+        # パス→レコードごとの(ブロック番号, 開始, 長さ)を平たく並べたもの
+        self.files: Dict[str, List[int]] = {}
+        self.num_blocks = 0
+
+    def add(self, path: str, record: bytes):
+        if len(self.buffer) > 0 and len(self.buffer) + len(record) > self.block_size:
+            self._flush()
+        self.files.setdefault(path, []).extend(
+            [self.num_blocks, len(self.buffer), len(record)]
+        )
+        self.buffer += record
+
+    def add_file(self, path: str, data: bytes, split: bool):
+        self.files.setdefault(path, [])
+        for record in split_records(Path(path), data) if split else [data]:
+            self.add(path, record)
+
+    def _flush(self):
+        data = bytes(self.buffer)
+        future = self.executor.submit(zlib.compress, data, self.level)
+        self.pending.append((future, len(data), zlib.crc32(data)))
+        self.buffer = bytearray()
+        self.num_blocks += 1
+        while len(self.pending) > self.max_pending:
+            self._write_pending()
+
+    def _write_pending(self):
+        future, length, crc = self.pending.popleft()
+        compressed = future.result()
+        self.blocks.append((self.file.tell(), len(compressed), length, crc))
+        self.file.write(compressed)
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self._flush()
+        while len(self.pending) > 0:
+            self._write_pending()
+        self.executor.shutdown()
+
+        index = zlib.compress(
+            json.dumps({"blocks": self.blocks, "files": self.files}).encode(),
+            self.level,
+        )
+        offset = self.file.tell()
+        self.file.write(index)
+        self.file.write(struct.pack(footer_format, offset, len(index)))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(cancel_futures=True)
+            self.file.close()
+            self.tmp_path.unlink()
+
+
+class BlockReader:
+    """
+    インデックスだけを読んでおき、レコードを読むときにそのブロックだけを展開する。
+    展開したブロックはcache_size個まで残しておく。
+    """
+
+    def __init__(self, path: Path, cache_size: int = 32):
+        self.file = path.open("rb")
+        assert self.file.read(len(magic)) == magic, path
+
+        footer_size = struct.calcsize(footer_format)
+        self.file.seek(-footer_size, os.SEEK_END)
+        offset, length = struct.unpack(footer_format, self.file.read(footer_size))
+        self.file.seek(offset)
+        index = json.loads(zlib.decompress(self.file.read(length)))
+
+        self.blocks: List[List[int]] = index["blocks"]
+        self.files: Dict[str, List[int]] = index["files"]
+
+        self.block = lru_cache(maxsize=cache_size)(self._block)
+
+    def _block(self, i: int):
+        offset, compressed_length, length, crc = self.blocks[i]
+        self.file.seek(offset)
+        data = zlib.decompress(self.file.read(compressed_length))
+        if len(data) != length or zlib.crc32(data) != crc:
+            raise ValueError(f"block {i} is corrupted")
+        return data
+
+    def paths(self):
+        return list(self.files)
+
+    def num_records(self, path: str):
+        return len(self.files[path]) // 3
+
+    def read(self, path: str, index: int = 0):
+        block, start, length = self.files[path][index * 3 : index * 3 + 3]
+        return self.block(block)[start : start + length]
+
+    def read_file(self, path: str):
+        return b"".join(self.read(path, i) for i in range(self.num_records(path)))
+
+    def __contains__(self, path: str):
+        return path in self.files
+
+    def close(self):
+        self.file.close()
+
+
+def export(
+    output_path: Path,
+    paths: List[Path],
+    root: Path,
+    block_size: int,
+    num_workers: int,
+):
+    files = collect_files(paths, root)
+    with BlockWriter(output_path, block_size=block_size, num_workers=num_workers) as w:
+        for path, split in files:
+            w.add_file(path, (root / path).read_bytes(), split=split)
+
+    size = sum((root / path).stat().st_size for path, _ in files)
+    print(
+        f"{len(files)} files, {len(w.blocks)} blocks, "
+        f"{size / 1e6:.1f} MB -> {output_path.stat().st_size / 1e6:.1f} MB"
+    )
+
+
+def import_(input_path: Path, output_dir: Path, prefixes: Optional[List[str]]):
+    reader = BlockReader(input_path)
+    for path in reader.paths():
+        check_path(path)
+    for path in reader.paths():
+        if prefixes is not None and not any(path.startswith(p) for p in prefixes):
+            continue
+        (output_dir / path).parent.mkdir(exist_ok=True, parents=True)
+        (output_dir / path).write_bytes(reader.read_file(path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("output_path", type=Path)
+    export_parser.add_argument("paths", type=Path, nargs="+")
+    export_parser.add_argument("--root", type=Path, default=Path("."))
+    export_parser.add_argument("--block_size", type=int, default=1 << 16)
+    export_parser.add_argument("--num_workers", type=int)
+
+    import_parser = subparsers.add_parser("import")
+    import_parser.add_argument("input_path", type=Path)
+    import_parser.add_argument("output_dir", type=Path)
+    import_parser.add_argument("--prefixes", nargs="+")
+
+    cat_parser = subparsers.add_parser("cat")
+    cat_parser.add_argument("input_path", type=Path)
+    cat_parser.add_argument("path")
+    cat_parser.add_argument("index", type=int, nargs="?")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export(
+            output_path=args.output_path,
+            paths=args.paths,
+            root=args.root,
+            block_size=args.block_size,
+            num_workers=args.num_workers,
+        )
+    elif args.command == "import":
+        import_(
+            input_path=args.input_path,
+            output_dir=args.output_dir,
+            prefixes=args.prefixes,
+        )
+    else:
+        reader = BlockReader(args.input_path)
+        if args.index is None:
+            print(reader.read_file(args.path).decode(), end="")
+        else:
+            print(reader.read(args.path, args.index).decode(), end="")
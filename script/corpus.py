@@ -0,0 +1,184 @@
+"""
+rohan4600の表と話者ごとの出力を、発話ごとに必要になったときに読む列として扱う。
+保存の形式ごとのバックエンドは、発話名の一覧と、番号から5種類の並びを読む関数だけを持つ。
+  TextBackend: rohan4600_*.txt（1行に1発話）
+  DirBackend: each.pyが書き出す話者ディレクトリ（1発話1ファイル）
+  DeltaBackend: each.py --deltaのdelta.tsv
+  BlockBackend: blockstore.pyでまとめたファイル
+"""
+
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+base_source = "rohan4600"
+
+# 話者の出力ディレクトリの中のディレクトリ名
+dir_names = [
+    "phoneme",
+    "accent_start",
+    "accent_end",
+    "accent_phrase_start",
+    "accent_phrase_end",
+]
+
+Streams = List[List[str]]
+
+
+@dataclass
+class Utterance:
+    name: str
+    phonemes: List[str]
+    accent_starts: List[str]
+    accent_ends: List[str]
+    accent_phrase_starts: List[str]
+    accent_phrase_ends: List[str]
+
+    def streams(self) -> Streams:
+        return [
+            self.phonemes,
+            self.accent_starts,
+            self.accent_ends,
+            self.accent_phrase_starts,
+            self.accent_phrase_ends,
+        ]
+
+    def rows(self) -> List[Tuple[str, str, str, str, str]]:
+        return list(zip(*self.streams()))
+
+
+class TextBackend:
+    def __init__(self, name: str = base_source):
+        from delta import base_names
+
+        self.lines = [
+            Path(f"{name}_{base_name}.txt").read_text().strip().splitlines()
+            for base_name in base_names
+        ]
+        assert all(len(lines) == len(self.lines[0]) for lines in self.lines), name
+        self.names = [f"{name}_{i + 1:04d}" for i in range(len(self.lines[0]))]
+
+    def read(self, index: int) -> Streams:
+        return [lines[index].split() for lines in self.lines]
+
+
+class DirBackend:
+    def __init__(self, target_dir: Path):
+        self.target_dir = target_dir
+        self.names = sorted(
+            path.stem for path in (target_dir / dir_names[0]).glob("*.txt")
+        )
+
+    def read(self, index: int) -> Streams:
+        stem = self.names[index]
+        return [
+            (self.target_dir / dir_name / f"{stem}.txt").read_text().split()
+            for dir_name in dir_names
+        ]
+
+
+class DeltaBackend:
+    def __init__(self, path: Path):
+        from delta import DeltaReader
+
+        # 組み立てた結果はCorpusがキャッシュするので、DeltaReaderでは持たない
+        self.reader = DeltaReader(path, cache_size=0)
+        self.names = self.reader.stems()
+
+    def read(self, index: int) -> Streams:
+        return self.reader.read_streams(self.names[index])
+
+
+class BlockBackend:
+    def __init__(self, path: Path, source: str):
+        from blockstore import BlockReader
+        from delta import base_names
+
+        self.reader = BlockReader(path)
+        self.source = source
+        self.base_names = base_names
+        if source == base_source:
+            num = self.reader.num_records(f"{source}_{base_names[0]}.txt")
+            self.names = [f"{source}_{i + 1:04d}" for i in range(num)]
+        else:
+            prefix = f"{source}/{dir_names[0]}/"
+            self.names = sorted(
+                Path(name).stem
+                for name in self.reader.paths()
+                if name.startswith(prefix)
+            )
+
+    def read(self, index: int) -> Streams:
+        if self.source == base_source:
+            paths = [(f"{self.source}_{name}.txt", index) for name in self.base_names]
+        else:
+            stem = self.names[index]
+            paths = [(f"{self.source}/{name}/{stem}.txt", 0) for name in dir_names]
+        return [self.reader.read(path, i).decode().split() for path, i in paths]
+
+
+Backend = Union[TextBackend, DirBackend, DeltaBackend, BlockBackend]
+
+
+class Corpus(Sequence[Utterance]):
+    """
+    発話の列。読んだ発話はcache_size個まで残しておく。
+    番号か発話名で引ける。
+    """
+
+    def __init__(self, backend: Backend, cache_size: int = 1024):
+        self.backend = backend
+        self.names: List[str] = backend.names
+        self.indices = {name: i for i, name in enumerate(self.names)}
+        self._read = lru_cache(maxsize=cache_size)(self._load)
+
+    def _load(self, index: int):
+        return Utterance(self.names[index], *self.backend.read(index))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._read(i) for i in range(len(self))[index]]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._read(index)
+
+    def __iter__(self) -> Iterator[Utterance]:
+        for i in range(len(self)):
+            yield self._read(i)
+
+    def get(self, name: str):
+        return self._read(self.indices[name])
+
+    def __contains__(self, name):
+        return name in self.indices
+
+
+def open_corpus(source: str, block_path: Optional[Path] = None, cache_size: int = 1024):
+    """
+    sourceが"rohan4600"ならその表を、それ以外は話者の出力ディレクトリを開く。
+    話者の出力ディレクトリはdelta.tsvか1発話1ファイルのどちらか一方だけを含むこと。
+    block_pathを指定した場合はblockstore.pyでまとめたファイルから読む。
+    """
+    from delta import delta_name
+
+    if block_path is not None:
+        backend: Backend = BlockBackend(block_path, source)
+    elif source == base_source:
+        backend = TextBackend(source)
+    else:
+        # 両方の形式がある場合、どちらが新しいかは分からないので読まない
+        has_delta = (Path(source) / delta_name).exists()
+        has_dir = (Path(source) / dir_names[0]).exists()
+        if has_delta and has_dir:
+            raise ValueError(f"{source} has both {delta_name} and per-file outputs")
+        if has_delta:
+            backend = DeltaBackend(Path(source) / delta_name)
+        else:
+            backend = DirBackend(Path(source))
+    return Corpus(backend, cache_size=cache_size)
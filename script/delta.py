@@ -0,0 +1,141 @@
+"""
+話者ごとの出力を、rohan4600の表からの差分として保存する。
+1発話を1行にし、元の表の何行目から作るかと、コピー・削除・挿入の並びを書く。
+  =N        元の表からN音素コピーする
+  -N        元の表のN音素を飛ばす
+  +p/s/e/ps/pe  音素とアクセント情報を1つ挿入する
+"""
+
+import argparse
+import hashlib
+from difflib import SequenceMatcher
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+Row = Tuple[str, str, str, str, str]
+
+base_names = [
+    "phonemes",
+    "accent_starts",
+    "accent_ends",
+    "accent_phrase_starts",
+    "accent_phrase_ends",
+]
+
+delta_name = "delta.tsv"
+
+
+def load_base(name: str = "rohan4600"):
+    tables = [
+        [
+            line.split()
+            for line in Path(f"{name}_{base_name}.txt").read_text().strip().splitlines()
+        ]
+        for base_name in base_names
+    ]
+    return [list(zip(*columns)) for columns in zip(*tables)]
+
+
+def base_digest(name: str = "rohan4600"):
+    # 元の表が変わった後に古い差分を読まないようにする
+    h = hashlib.sha256()
+    for base_name in base_names:
+        h.update(Path(f"{name}_{base_name}.txt").read_bytes())
+    return h.hexdigest()
+
+
+def encode_delta(base_rows: Sequence[Row], rows: Sequence[Row]):
+    ops: List[str] = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(
+        None, base_rows, rows, autojunk=False
+    ).get_opcodes():
+        if tag == "equal":
+            ops.append(f"={i2 - i1}")
+            continue
+        if i2 > i1:
+            ops.append(f"-{i2 - i1}")
+        ops += ["+" + "/".join(row) for row in rows[j1:j2]]
+    return " ".join(ops)
+
+
+def decode_delta(base_rows: Sequence[Row], ops: str):
+    rows: List[Row] = []
+    i = 0
+    for op in ops.split():
+        if op[0] == "=":
+            n = int(op[1:])
+            rows += base_rows[i : i + n]
+            i += n
+        elif op[0] == "-":
+            i += int(op[1:])
+        elif op[0] == "+":
+            rows.append(tuple(op[1:].split("/")))
+        else:
+            raise ValueError(f"invalid op: {op}")
+    return rows
+
+
+def write_delta(path: Path, digest: str, lines: List[Tuple[str, int, str]]):
+    text = f"#base\t{digest}\n"
+    text += "".join(f"{stem}\t{index}\t{ops}\n" for stem, index, ops in lines)
+    path.write_text(text)
+
+
+class DeltaReader:
+    """
+    差分から発話ごとの音素とアクセント情報を組み立てる。
+    よく読まれる発話のためにcache_size個まで組み立てた結果を残しておく。
+    """
+
+    def __init__(
+        self, path: Path, base_name: str = "rohan4600", cache_size: int = 1024
+    ):
+        lines = path.read_text().splitlines()
+        header, digest = lines[0].split("\t")
+        assert header == "#base", path
+        if digest != base_digest(base_name):
+            raise ValueError(f"base table changed since {path} was written")
+
+        self.base_rows = load_base(base_name)
+        self.entries: Dict[str, Tuple[int, str]] = {}
+        for line in lines[1:]:
+            stem, index, ops = line.split("\t")
+            self.entries[stem] = (int(index), ops)
+
+        self.read = lru_cache(maxsize=cache_size)(self._read)
+
+    def stems(self):
+        return list(self.entries)
+
+    def _read(self, stem: str):
+        index, ops = self.entries[stem]
+        return decode_delta(self.base_rows[index], ops)
+
+    def read_streams(self, stem: str):
+        # each.pyが書き出すファイルと同じ、音素・アクセント情報ごとの並びにする
+        rows = self.read(stem)
+        return [[row[i] for row in rows] for i in range(len(base_names))]
+
+    def __contains__(self, stem: str):
+        return stem in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+if __name__ == "__main__":
+    # 差分から元の形式のファイルを書き出す
+    parser = argparse.ArgumentParser()
+    parser.add_argument("delta_path", type=Path)
+    parser.add_argument("output_dir", type=Path)
+    args = parser.parse_args()
+
+    from each import dir_names
+
+    reader = DeltaReader(args.delta_path)
+    for dir_name in dir_names:
+        (args.output_dir / dir_name).mkdir(exist_ok=True, parents=True)
+    for stem in reader.stems():
+        for dir_name, stream in zip(dir_names, reader.read_streams(stem)):
+            (args.output_dir / dir_name / f"{stem}.txt").write_text(" ".join(stream))
@@ -0,0 +1,480 @@
+"""
+高速化などで書き換えた関数が、元の実装と同じ結果を返すかを確かめる。
+gitのリビジョン（基準）のscript/と、作業ツリー（候補）のscript/を両方importして、
+コーパス全体と境界ケースに対して結果を比較し、最初の不一致と速度比を表示する。
+候補の結果はコミット済みのrohan4600_*.txt、each_memo.txtと話者ディレクトリの出力とも比較する。
+
+リポジトリのルートで実行すること。
+"""
+
+import argparse
+import copy
+import importlib
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import astuple, dataclass, field
+from pathlib import Path
+from types import ModuleType
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from corpus import dir_names
+from mora import mora_spans
+
+script_dir = Path(__file__).parent
+
+# 比較する関数を持つモジュール
+module_names = ["phoneme", "accent_post", "each"]
+
+# 長音・う゛・くゎ/ぐゎ・表記ゆれなど、コーパスに少ないもの
+edge_yomis = [
+    "こーひー",
+    "らーめんとぱすたー",
+    "う゛ぁいおりん",
+    "う゛",
+    "ゔぃーなす",
+    "くゎし",
+    "ぐゎいこく",
+    "つづき",
+    "ちぢむ",
+    "ほんをよむ",
+    "ふゅーじょん",
+    "しぃっと",
+    "てぃーでぃーでゅお",
+    "きって、ん",
+    "ぱうぱう",
+]
+
+edge_memos = [
+    "こ'ーひー",
+    "う゛ぁ'いおりん|、|くゎ'し",
+    "ぐゎいこく'|、|ふゅ'ーじょん",
+    "つづき'|ちぢむ'|ほんお'|よむ'",
+    "しぃ'っと|てぃ'ー",
+]
+
+
+@dataclass
+class Label:
+    # FullContextLabelの代わりに、make_memoとdecideが使う属性だけ持つ
+    phoneme: str
+    contexts: Dict[str, str] = field(default_factory=dict)
+
+
+@dataclass
+class Result:
+    name: str
+    cases: int = 0
+    divergences: List[Tuple[str, str]] = field(default_factory=list)
+    reference_time: float = 0
+    candidate_time: float = 0
+
+
+def local_module_names(directory: Path):
+    # script/のモジュールは互いにimportし合うので、どちらかにあるものは全て入れ替える
+    return {path.stem for d in [directory, script_dir] for path in d.glob("*.py")} - {
+        "difftest"
+    }
+
+
+def load_modules(directory: Path, skipped: List[str]):
+    # 同じ名前のモジュールを別のディレクトリから読み込むため、sys.modulesを退避する
+    names = local_module_names(directory)
+    saved = {name: sys.modules.pop(name) for name in names if name in sys.modules}
+    sys.path.insert(0, str(directory))
+    importlib.invalidate_caches()
+
+    modules: Dict[str, ModuleType] = {}
+    try:
+        for name in module_names:
+            if not (directory / f"{name}.py").exists():
+                continue
+            try:
+                modules[name] = importlib.import_module(name)
+            except ImportError as e:
+                print(f"skip {directory / name}.py: {e}")
+                skipped.append(f"{directory / name}.py")
+    finally:
+        sys.path.remove(str(directory))
+        for name in names:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+    return modules
+
+
+def checkout_script(revision: str, directory: Path):
+    names = subprocess.run(
+        ["git", "ls-tree", "--name-only", revision, "script/"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    for name in names:
+        if name.endswith(".py"):
+            source = subprocess.run(
+                ["git", "show", f"{revision}:{name}"], check=True, capture_output=True
+            ).stdout
+            (directory / Path(name).name).write_bytes(source)
+
+
+def normalize(value: Any) -> Any:
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    if hasattr(value, "contexts"):
+        return ("label", value.phoneme, dict(value.contexts))
+    if hasattr(value, "__dataclass_fields__"):
+        return (type(value).__name__, normalize(list(vars(value).values())))
+    return value
+
+
+def call(function: Callable, args: Sequence[Any]):
+    # 例外も結果として比較する。ただし依存が無いなどの環境の問題は比較できないので、そのまま投げる
+    args = copy.deepcopy(args)
+    t = time.perf_counter()
+    try:
+        output = normalize(function(*args))
+    except ImportError:
+        raise
+    except Exception as e:
+        output = ("exception", type(e).__name__, str(e))
+    return output, time.perf_counter() - t
+
+
+def first_divergence(reference: Any, candidate: Any, path: str = "") -> Optional[str]:
+    if isinstance(reference, list) and isinstance(candidate, list):
+        for i, (r, c) in enumerate(zip(reference, candidate)):
+            divergence = first_divergence(r, c, f"{path}[{i}]")
+            if divergence is not None:
+                return divergence
+        if len(reference) != len(candidate):
+            return f"{path} length {len(reference)} != {len(candidate)}"
+        return None
+    if isinstance(reference, str) and isinstance(candidate, str):
+        if reference != candidate:
+            i = next(
+                (i for i, (r, c) in enumerate(zip(reference, candidate)) if r != c),
+                min(len(reference), len(candidate)),
+            )
+            return f"{path} at {i}: {reference[i:i + 20]!r} != {candidate[i:i + 20]!r}"
+        return None
+    if reference != candidate:
+        return f"{path} {reference!r} != {candidate!r}"
+    return None
+
+
+def compare(
+    name: str,
+    reference: Callable,
+    candidate: Callable,
+    cases: Sequence[Tuple[str, Sequence[Any]]],
+):
+    result = Result(name=name)
+    for i, (case_name, args) in enumerate(cases):
+        # 先に実行した方が不利にならないよう、順番を入れ替える
+        if i % 2 == 0:
+            reference_output, reference_time = call(reference, args)
+            candidate_output, candidate_time = call(candidate, args)
+        else:
+            candidate_output, candidate_time = call(candidate, args)
+            reference_output, reference_time = call(reference, args)
+
+        result.cases += 1
+        result.reference_time += reference_time
+        result.candidate_time += candidate_time
+
+        divergence = first_divergence(reference_output, candidate_output)
+        if divergence is not None:
+            result.divergences.append((case_name, divergence))
+    return result
+
+
+def golden(name: str, function: Callable, cases: Sequence[Tuple[str, Any, Any]]):
+    # コミット済みのファイルと一致するか
+    result = Result(name=name)
+    for case_name, args, expected in cases:
+        output, candidate_time = call(function, args)
+        result.cases += 1
+        result.candidate_time += candidate_time
+        divergence = first_divergence(normalize(expected), output)
+        if divergence is not None:
+            result.divergences.append((case_name, divergence))
+    return result
+
+
+def read_each_memo(path: Path):
+    # (話者, ファイル名) → 5種類の並び
+    lines = path.read_text().strip().splitlines() if path.exists() else []
+    return {
+        tuple(lines[i].split()): [line.split() for line in lines[i + 1 : i + 6]]
+        for i in range(0, len(lines), 6)
+    }
+
+
+def create_labels(
+    phonemes: List[str],
+    accent_ends: Optional[List[str]] = None,
+    accent_phrase_ends: Optional[List[str]] = None,
+):
+    # コミット済みの音素列とアクセントからOpenJTalkのラベルの代わりを作る
+    # アクセント核のモーラ末でa1=0、アクセント句末のモーラ末でa3=1にする
+    accent_ends = accent_ends or ["0"] * len(phonemes)
+    accent_phrase_ends = accent_phrase_ends or ["0"] * len(phonemes)
+
+    labels = [Label(p, {"a1": "1", "a3": "2", "p3": p}) for p in phonemes]
+    for _, e in mora_spans(phonemes):
+        if accent_ends[e - 1] == "1":
+            labels[e - 1].contexts["a1"] = "0"
+        if accent_phrase_ends[e - 1] == "1":
+            labels[e - 1].contexts["a3"] = "1"
+    return labels
+
+
+def perturb(phonemes: List[str], rng: random.Random):
+    # decideが吸収すべき差分を入れたOpenJTalk側の音素列
+    ojt = list(phonemes)
+    for i in range(len(ojt) - 1):
+        r = rng.random()
+        if r < 0.05 and ojt[i] in ("i", "u"):
+            ojt[i] = ojt[i].upper()
+        elif r < 0.07 and ojt[i : i + 2] in (["o", "u"], ["e", "i"]):
+            ojt[i + 1] = ojt[i]
+        elif r < 0.08 and ojt[i] == "pau":
+            ojt[i] = "N"
+    if rng.random() < 0.1:
+        ojt.insert(rng.randrange(len(ojt) + 1), "pau")
+    return ojt
+
+
+def difftest(
+    reference: str,
+    candidate_dir: Path,
+    root_dir: Optional[Path],
+    each_memo_path: Path,
+    limit: Optional[int],
+    max_report: int,
+    seed: int,
+):
+    # 比較できなかったものがあれば、不一致が無くても失敗にする
+    skipped: List[str] = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkout_script(reference, Path(directory))
+        ref = load_modules(Path(directory), skipped)
+    cand = load_modules(candidate_dir, skipped)
+
+    phoneme_texts = Path("rohan4600_phonemes.txt").read_text().splitlines()
+    memo_lines = Path("rohan4600_memo.txt").read_text().splitlines()
+    yomis = memo_lines[1::3]
+    bases = [
+        Path(f"rohan4600_{name}.txt").read_text().splitlines()
+        for name in [
+            "phonemes",
+            "accent_starts",
+            "accent_ends",
+            "accent_phrase_starts",
+            "accent_phrase_ends",
+        ]
+    ]
+    if limit is not None:
+        phoneme_texts, yomis = phoneme_texts[:limit], yomis[:limit]
+        bases = [base[:limit] for base in bases]
+
+    rng = random.Random(seed)
+    results: List[Result] = []
+
+    def run(
+        module: str,
+        name: str,
+        cases: Sequence[Tuple[str, Sequence[Any]]],
+        label: str = "",
+    ):
+        if module not in ref or module not in cand:
+            print(f"skip {module}.{name}")
+            skipped.append(f"{module}.{name}")
+            return
+        try:
+            results.append(
+                compare(
+                    f"{module}.{name}{label}",
+                    getattr(ref[module], name),
+                    getattr(cand[module], name),
+                    cases,
+                )
+            )
+        except ImportError as e:
+            print(f"skip {module}.{name}{label}: {e}")
+            skipped.append(f"{module}.{name}{label}")
+
+    def run_golden(
+        name: str, function: Callable, cases: Sequence[Tuple[str, Any, Any]]
+    ):
+        try:
+            results.append(golden(name, function, cases))
+        except ImportError as e:
+            print(f"skip {name}: {e}")
+            skipped.append(name)
+
+    kana_yomis = [y.replace("'", "").replace("|", "") for y in yomis]
+    run(
+        "phoneme",
+        "text2phoneme",
+        [(f"memo{i + 1}", (y,)) for i, y in enumerate(kana_yomis)]
+        + [(f"edge:{y}", (y,)) for y in edge_yomis],
+    )
+
+    memo_cases = [(f"memo{i + 1}", (y,)) for i, y in enumerate(yomis)]
+    memo_cases += [(f"edge:{y}", (y,)) for y in edge_memos]
+    run("accent_post", "yomi_to_phones", memo_cases)
+    run("accent_post", "yomi_to_accents", memo_cases)
+
+    if "accent_post" not in cand:
+        print("skip accent_post.modify_phonemes")
+        skipped.append("accent_post.modify_phonemes")
+    else:
+        run(
+            "accent_post",
+            "modify_phonemes",
+            [
+                (
+                    f"memo{i + 1}",
+                    (cand["accent_post"].yomi_to_phones(y), p.split()[1:-1]),
+                )
+                for i, (y, p) in enumerate(zip(yomis, phoneme_texts))
+            ],
+        )
+
+        def accent_row(yomi: str):
+            return [
+                " ".join(["0"] + list(accents) + ["0"])
+                for accents in cand["accent_post"].yomi_to_accents(yomi)
+            ]
+
+        run_golden(
+            "accent_post.yomi_to_accents (committed files)",
+            accent_row,
+            [
+                (f"memo{i + 1}", (y,), [base[i] for base in bases[1:]])
+                for i, y in enumerate(yomis)
+            ],
+        )
+
+    label_cases = []
+    decide_cases = []
+    for i, (phoneme_text, _, accent_end_text, _, accent_phrase_end_text) in enumerate(
+        zip(*bases)
+    ):
+        phonemes = phoneme_text.split()[1:-1]
+        labels: List[Any] = create_labels(
+            phonemes,
+            accent_end_text.split()[1:-1],
+            accent_phrase_end_text.split()[1:-1],
+        )
+        # ラベルが無い音素は文字列のまま入る
+        if rng.random() < 0.1:
+            j = rng.randrange(len(labels))
+            labels[j] = labels[j].phoneme
+        label_cases.append((f"rohan{i + 1}", (labels,)))
+
+        ojt_phones = perturb([p.lower() for p in phonemes], rng)
+        ojt_labels = create_labels(ojt_phones)
+        decide_cases.append(
+            (f"rohan{i + 1}", ([p.lower() for p in phonemes], ojt_labels))
+        )
+
+    for jul_phones in [["kw", "a", "sh", "i"], ["gw", "a", "i"], ["v", "a", "i"]]:
+        ojt_phones = [
+            q
+            for p in jul_phones
+            for q in ({"kw": ["k", "u"], "gw": ["g", "u"], "v": ["b"]}.get(p, [p]))
+        ]
+        decide_cases.append(
+            (f"edge:{jul_phones}", (jul_phones, create_labels(ojt_phones)))
+        )
+
+    run("phoneme", "make_memo", label_cases)
+    run("phoneme", "decide", decide_cases)
+
+    if root_dir is not None:
+        base_infos = (
+            cand["each"]._create_phoneme_infos("rohan4600") if "each" in cand else []
+        )
+        each_memo = read_each_memo(each_memo_path)
+
+        def each_row(labs_path: Path, infos: List[Any], memo: Optional[List[Any]]):
+            # each.pyが書き出す内容。メモにあるものはメモを使い、音素列はprocessと一致するはず
+            process = cand["each"].process
+            if memo is None:
+                each_infos, _ = process(labs_path, infos, force=False)
+                return [" ".join(s) for s in zip(*map(astuple, each_infos))]
+            each_infos, _ = process(labs_path, infos, force=True)
+            return [" ".join(pi.phoneme for pi in each_infos)] + [
+                " ".join(stream) for stream in memo[1:]
+            ]
+
+        for target in sorted(p.parent.name for p in root_dir.glob("*/*/label")):
+            speaker, _ = target.rsplit("-", 1)
+            labs_paths = sorted((root_dir / speaker / target / "label").glob("*.lab"))
+            for force in [False, True]:
+                run(
+                    "each",
+                    "process",
+                    [
+                        (f"{p.stem}:force={force}", (p, infos, force))
+                        for p, infos in zip(labs_paths[: len(yomis)], base_infos)
+                    ],
+                    label=f" {target} force={force}",
+                )
+
+            # コミット済みの話者ディレクトリがあれば、その出力と比較する
+            if "each" not in cand or not (Path(target) / dir_names[0]).is_dir():
+                continue
+            run_golden(
+                f"each.process {target} (committed files)",
+                each_row,
+                [
+                    (
+                        p.stem,
+                        (p, infos, each_memo.get((target, p.stem))),
+                        [
+                            (Path(target) / name / f"{p.stem}.txt").read_text()
+                            for name in dir_names
+                        ],
+                    )
+                    for p, infos in zip(labs_paths[: len(yomis)], base_infos)
+                    if (Path(target) / dir_names[0] / f"{p.stem}.txt").exists()
+                ],
+            )
+
+    for result in results:
+        speedup = (
+            result.reference_time / result.candidate_time
+            if result.reference_time > 0 and result.candidate_time > 0
+            else None
+        )
+        print(
+            f"{result.name}: {result.cases} cases, "
+            f"{len(result.divergences)} divergent"
+            + (f", speedup x{speedup:.2f}" if speedup is not None else "")
+        )
+        for case_name, divergence in result.divergences[:max_report]:
+            print(f"  {case_name}: {divergence}")
+
+    if len(skipped) > 0:
+        print(f"{len(skipped)} skipped: {', '.join(skipped)}")
+    if any(len(result.divergences) > 0 for result in results) or len(skipped) > 0:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reference", default="HEAD")
+    parser.add_argument("--candidate_dir", type=Path, default=script_dir)
+    parser.add_argument("--root_dir", type=Path)
+    parser.add_argument("--each_memo_path", type=Path, default=Path("each_memo.txt"))
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--max_report", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    difftest(**vars(args))
@@ -5,13 +5,27 @@ FIXME: つもりだったけど、ラベルファイル側の誤りが多いた
 
 import argparse
 from copy import deepcopy
-from dataclasses import dataclass
+from dataclasses import astuple, dataclass
 from difflib import SequenceMatcher
 from pathlib import Path
-from typing import List
-
-from acoustic_feature_extractor.data.phoneme import OjtPhoneme
-from tqdm import tqdm
+from typing import Dict, List, Optional, Tuple
+
+from corpus import dir_names, open_corpus
+from delta import base_digest, delta_name, encode_delta, write_delta
+from frame import expand_frames, load_lab_times, pack_flags, write_frames
+from length_index import IndexRow, create_index_row, write_index
+from mora import to_mora_features
+from shard import in_shard, parse_shard, write_manifest
+from writer import StagedWriter
+
+mora_dir_names = [
+    "mora",
+    "mora_offset",
+    "mora_accent_start",
+    "mora_accent_end",
+    "mora_accent_phrase_start",
+    "mora_accent_phrase_end",
+]
 
 
 @dataclass
@@ -33,64 +47,22 @@ def copy_phoneme_info(phoneme_info: PhonemeInfo, phoneme: str):
     )
 
 
-def _load_split(file_name: str):
-    return [
-        s.strip().split()
-        for s in Path(f"{file_name}.txt").read_text().strip().splitlines()
-    ]
-
-
 def _create_phoneme_infos(name: str):
     return [
-        [
-            PhonemeInfo(
-                phoneme,
-                accent_start,
-                accent_end,
-                accent_phrase_start,
-                accent_phrase_end,
-            )
-            for (
-                phoneme,
-                accent_start,
-                accent_end,
-                accent_phrase_start,
-                accent_phrase_end,
-            ) in zip(*info_lists)
-        ]
-        for info_lists in zip(
-            _load_split(f"{name}_phonemes"),
-            _load_split(f"{name}_accent_starts"),
-            _load_split(f"{name}_accent_ends"),
-            _load_split(f"{name}_accent_phrase_starts"),
-            _load_split(f"{name}_accent_phrase_ends"),
-        )
+        [PhonemeInfo(*row) for row in utterance.rows()]
+        for utterance in open_corpus(name, cache_size=0)
     ]
 
 
-def process(labs_path: Path, base_phoneme_info_list: List[PhonemeInfo], force: bool):
-    labs = OjtPhoneme.load_julius_list(labs_path)
-    labs[0].phoneme = labs[-1].phoneme = "sil"
-
-    base_phoneme_list = [
-        phoneme_info.phoneme for phoneme_info in base_phoneme_info_list
-    ]
-    each_phoneme_list = [lab.phoneme for lab in labs]
-
+def normalize_phonemes(phonemes: List[str]):
     # 有声・無声を無視
-    base_phoneme_list = [
-        p if p not in ["A", "I", "U", "E", "O"] else p.lower()
-        for p in base_phoneme_list
-    ]
-    each_phoneme_list = [
-        p if p not in ["A", "I", "U", "E", "O"] else p.lower()
-        for p in each_phoneme_list
-    ]
+    return [p if p not in ["A", "I", "U", "E", "O"] else p.lower() for p in phonemes]
 
-    each_phoneme_info_list: List[PhonemeInfo] = []
-
-    unexpcted = False
 
+def classify_opcodes(base_phoneme_list: List[str], each_phoneme_list: List[str]):
+    """
+    台本とラベルの音素列の差分を分類する。equal以外が違い。
+    """
     for tag, i1, i2, j1, j2 in SequenceMatcher(
         None, base_phoneme_list, each_phoneme_list
     ).get_opcodes():
@@ -98,7 +70,7 @@ def process(labs_path: Path, base_phoneme_info_list: List[PhonemeInfo], force: b
         ep = each_phoneme_list[j1:j2]
 
         if tag == "equal":
-            each_phoneme_info_list += base_phoneme_info_list[i1:i2]
+            category = "equal"
 
         # いう→ゆう
         elif (
@@ -110,29 +82,73 @@ def process(labs_path: Path, base_phoneme_info_list: List[PhonemeInfo], force: b
             and base_phoneme_list[i2] == "u"
             and each_phoneme_list[j2] == "u"
         ):
-            each_phoneme_info_list += [
-                copy_phoneme_info(base_phoneme_info_list[i1], ep[0]),
-                copy_phoneme_info(base_phoneme_info_list[i1], ep[1]),
-            ]
+            category = "iu_yu"
 
         # 無音が消された
         elif tag == "delete" and i2 - i1 == 1 and bp == ["pau"]:
-            pass
+            category = "pau_deleted"
 
         # 無音が足された
         elif tag == "insert" and j2 - j1 == 1 and ep == ["pau"]:
-            each_phoneme_info_list += [PhonemeInfo("pau", "0", "0", "0", "0")]
+            category = "pau_inserted"
 
         # 一文字だけ違う
         elif tag == "replace" and i2 - i1 == 1 and j2 - j1 == 1:
+            category = "replace_one"
+
+        # 予期せず消された・足された・違った
+        elif tag in ("delete", "insert", "replace"):
+            category = f"unexpected_{tag}"
+
+        else:
+            raise ValueError(f"{tag}, {bp}, {ep}")
+
+        yield category, tag, i1, i2, j1, j2
+
+
+def process(labs_path: Path, base_phoneme_info_list: List[PhonemeInfo], force: bool):
+    from acoustic_feature_extractor.data.phoneme import OjtPhoneme
+
+    labs = OjtPhoneme.load_julius_list(labs_path)
+    labs[0].phoneme = labs[-1].phoneme = "sil"
+
+    base_phoneme_list = normalize_phonemes(
+        [phoneme_info.phoneme for phoneme_info in base_phoneme_info_list]
+    )
+    each_phoneme_list = normalize_phonemes([lab.phoneme for lab in labs])
+
+    each_phoneme_info_list: List[PhonemeInfo] = []
+
+    unexpcted = False
+
+    for category, tag, i1, i2, j1, j2 in classify_opcodes(
+        base_phoneme_list, each_phoneme_list
+    ):
+        ep = each_phoneme_list[j1:j2]
+
+        if category == "equal":
+            each_phoneme_info_list += base_phoneme_info_list[i1:i2]
+
+        elif category == "iu_yu":
+            each_phoneme_info_list += [
+                copy_phoneme_info(base_phoneme_info_list[i1], ep[0]),
+                copy_phoneme_info(base_phoneme_info_list[i1], ep[1]),
+            ]
+
+        elif category == "pau_deleted":
+            pass
+
+        elif category == "pau_inserted":
+            each_phoneme_info_list += [PhonemeInfo("pau", "0", "0", "0", "0")]
+
+        elif category == "replace_one":
             each_phoneme_info_list += [
                 copy_phoneme_info(base_phoneme_info_list[i1], ep[0])
             ]
 
             unexpcted = True
 
-        # 予期せず消された
-        elif tag == "delete":
+        elif category == "unexpected_delete":
             if not force:
                 phoneme_info_lists = deepcopy(base_phoneme_info_list[i1:i2])
                 for phoneme_info_list in phoneme_info_lists:
@@ -141,21 +157,8 @@ def process(labs_path: Path, base_phoneme_info_list: List[PhonemeInfo], force: b
 
             unexpcted = True
 
-        # 予期せず足された
-        elif tag == "insert":
-            if not force:
-                each_phoneme_info_list += [
-                    PhonemeInfo(p, "?", "?", "?", "?") for p in ep
-                ]
-            else:
-                each_phoneme_info_list += [
-                    copy_phoneme_info(base_phoneme_info_list[i1], p) for p in ep
-                ]
-
-            unexpcted = True
-
-        # 予期せず違った
-        elif tag == "replace":
+        # 予期せず足された・違った
+        else:
             if not force:
                 each_phoneme_info_list += [
                     PhonemeInfo(p, "?", "?", "?", "?") for p in ep
@@ -167,9 +170,6 @@ def process(labs_path: Path, base_phoneme_info_list: List[PhonemeInfo], force: b
 
             unexpcted = True
 
-        else:
-            raise ValueError(f"{tag}, {bp}, {ep}")
-
     return each_phoneme_info_list, unexpcted
 
 
@@ -184,9 +184,41 @@ def phoneme_info_list_memo(name: str, stem: str, phoneme_info_list: List[Phoneme
     return memo_text
 
 
-def each(root_dir: Path, memo_path: Path, force: bool):
+def each(
+    root_dir: Path,
+    memo_path: Path,
+    force: bool,
+    targets: List[str],
+    shard: Optional[Tuple[int, int]],
+    output_dir: Path,
+    mora: bool,
+    delta: bool,
+    frame_shift: Optional[float],
+    profile_memory: bool,
+    profile: Optional[Path],
+):
+    from tqdm import tqdm
+
+    from profiling import Profiler
+
+    # 差分からモーラの特徴量は作れるので、差分のときは書き出さない
+    if delta and mora:
+        raise ValueError("--delta and --mora cannot be used together")
+
+    # シャードのメモは出力ディレクトリに書くので、元のメモを上書きしないようにする
+    shard_memo_path = output_dir / memo_path.name
+    if shard is not None and shard_memo_path.resolve() == memo_path.resolve():
+        raise ValueError(
+            f"--shard needs an --output_dir other than the directory of {memo_path}"
+        )
+
+    profiler = Profiler(memory=profile_memory, cpu_dir=profile)
+
+    profiler.start("load_base")
     rohan4600_phoneme_info_lists = _create_phoneme_infos("rohan4600")
+    profiler.stop(utterances=len(rohan4600_phoneme_info_lists))
 
+    profiler.start("load_memo")
     memo_dict = {}
     if memo_path.exists():
         memo_lines = memo_path.read_text().strip().splitlines()
@@ -204,26 +236,49 @@ def each(root_dir: Path, memo_path: Path, force: bool):
                 memo_lines[5::6],
             )
         }
+    profiler.stop(utterances=len(memo_dict))
 
     memo_text = ""
-    for speaker, style in [["zundamon", "normal"]]:
-        target = f"{speaker}-{style}"
+    target_manifests: Dict[str, Dict[str, List[str]]] = {}
+    for target in targets:
+        speaker, _ = target.rsplit("-", 1)
         print(target)
+        profiler.start(f"process:{target}")
 
-        (Path(target) / "phoneme").mkdir(exist_ok=True, parents=True)
-        (Path(target) / "accent_start").mkdir(exist_ok=True, parents=True)
-        (Path(target) / "accent_end").mkdir(exist_ok=True, parents=True)
-        (Path(target) / "accent_phrase_start").mkdir(exist_ok=True, parents=True)
-        (Path(target) / "accent_phrase_end").mkdir(exist_ok=True, parents=True)
+        target_dir = output_dir / target
+        target_dir_names = dir_names + (mora_dir_names if mora else [])
+        if delta:
+            target_dir_names = []
+
+        # 前回と別の形式で書き出す場合は、前回の形式の出力を引き継がない
+        discard = dir_names + mora_dir_names if delta else [delta_name]
+        writer = StagedWriter(target_dir, target_dir_names, discard=discard)
 
         phoneme_info_lists = rohan4600_phoneme_info_lists
         labs_paths = sorted((root_dir / speaker / target / "label").glob("*.lab"))
 
         assert len(phoneme_info_lists) == len(labs_paths)
 
+        target_manifest: Dict[str, List[str]] = {
+            "all_stems": [labs_path.stem for labs_path in labs_paths],
+            "stems": [],
+            "written": [],
+            "dir_names": target_dir_names,
+        }
+        target_manifests[target] = target_manifest
+        index_rows: List[IndexRow] = []
+        base_indices = {labs_path.stem: i for i, labs_path in enumerate(labs_paths)}
+        delta_lines: List[Tuple[str, int, str]] = []
+        frame_rows: List[Tuple[str, bytes]] = []
+
         for phoneme_info_list, labs_path in tqdm(zip(phoneme_info_lists, labs_paths)):
             stem = labs_path.stem
 
+            # 他のシャードが担当する
+            if shard is not None and not in_shard(stem, shard):
+                continue
+            target_manifest["stems"].append(stem)
+
             # メモに存在
             if (target, stem) in memo_dict:
                 each_phoneme_info_list = memo_dict[(target, stem)]
@@ -259,37 +314,117 @@ def each(root_dir: Path, memo_path: Path, force: bool):
 
             # 書き出し
             else:
-                path = Path(target) / "phoneme" / f"{stem}.txt"
-                path.write_text(" ".join([pi.phoneme for pi in each_phoneme_info_list]))
-
-                path = Path(target) / "accent_start" / f"{stem}.txt"
-                path.write_text(
-                    " ".join([pi.accent_start for pi in each_phoneme_info_list])
+                target_manifest["written"].append(stem)
+                index_rows.append(
+                    create_index_row(
+                        stem,
+                        [pi.phoneme for pi in each_phoneme_info_list],
+                        [pi.accent_phrase_start for pi in each_phoneme_info_list],
+                    )
                 )
 
-                path = Path(target) / "accent_end" / f"{stem}.txt"
-                path.write_text(
-                    " ".join([pi.accent_end for pi in each_phoneme_info_list])
+                if frame_shift is not None:
+                    packed = pack_flags(
+                        [
+                            [pi.accent_start for pi in each_phoneme_info_list],
+                            [pi.accent_end for pi in each_phoneme_info_list],
+                            [pi.accent_phrase_start for pi in each_phoneme_info_list],
+                            [pi.accent_phrase_end for pi in each_phoneme_info_list],
+                        ]
+                    )
+                    frame_rows.append(
+                        (
+                            stem,
+                            expand_frames(
+                                packed, load_lab_times(labs_path), frame_shift
+                            ),
+                        )
+                    )
+
+                if delta:
+                    delta_lines.append(
+                        (
+                            stem,
+                            base_indices[stem],
+                            encode_delta(
+                                [astuple(pi) for pi in phoneme_info_list],
+                                [astuple(pi) for pi in each_phoneme_info_list],
+                            ),
+                        )
+                    )
+                    continue
+
+                writer.write(
+                    f"phoneme/{stem}.txt",
+                    " ".join([pi.phoneme for pi in each_phoneme_info_list]),
                 )
-
-                path = Path(target) / "accent_phrase_start" / f"{stem}.txt"
-                path.write_text(
-                    " ".join([pi.accent_phrase_start for pi in each_phoneme_info_list])
+                writer.write(
+                    f"accent_start/{stem}.txt",
+                    " ".join([pi.accent_start for pi in each_phoneme_info_list]),
                 )
-
-                path = Path(target) / "accent_phrase_end" / f"{stem}.txt"
-                path.write_text(
-                    " ".join([pi.accent_phrase_end for pi in each_phoneme_info_list])
+                writer.write(
+                    f"accent_end/{stem}.txt",
+                    " ".join([pi.accent_end for pi in each_phoneme_info_list]),
+                )
+                writer.write(
+                    f"accent_phrase_start/{stem}.txt",
+                    " ".join([pi.accent_phrase_start for pi in each_phoneme_info_list]),
+                )
+                writer.write(
+                    f"accent_phrase_end/{stem}.txt",
+                    " ".join([pi.accent_phrase_end for pi in each_phoneme_info_list]),
                 )
 
-    if len(memo_text) > 0:
+                if mora:
+                    mora_features = to_mora_features(
+                        [pi.phoneme for pi in each_phoneme_info_list],
+                        [pi.accent_start for pi in each_phoneme_info_list],
+                        [pi.accent_end for pi in each_phoneme_info_list],
+                        [pi.accent_phrase_start for pi in each_phoneme_info_list],
+                        [pi.accent_phrase_end for pi in each_phoneme_info_list],
+                    )
+                    for dir_name, feature in zip(mora_dir_names, mora_features):
+                        writer.write(f"{dir_name}/{stem}.txt", " ".join(feature))
+
+        if frame_shift is not None:
+            write_frames(writer.staging_dir, frame_shift, frame_rows)
+        if delta:
+            write_delta(writer.staging_dir / delta_name, base_digest(), delta_lines)
+        write_index(writer.staging_dir / "index.tsv", index_rows)
+        writer.commit()
+        profiler.stop(utterances=len(target_manifest["stems"]))
+
+    # シャードごとのメモは後でマージする
+    if shard is not None:
+        shard_memo_path.write_text(memo_text)
+        write_manifest(
+            output_dir,
+            kind="each",
+            shard=shard,
+            memo_name=memo_path.name,
+            delta=delta,
+            frame_shift=frame_shift,
+            targets=target_manifests,
+        )
+
+    elif len(memo_text) > 0:
         memo_path.write_text(memo_text)
 
+    profiler.report()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--root_dir", type=Path)
     parser.add_argument("--memo_path", type=Path, default=Path("each_memo.txt"))
     parser.add_argument("--force", action="store_true")
+    parser.add_argument("--targets", nargs="+", default=["zundamon-normal"])
+    parser.add_argument("--shard", type=parse_shard)
+    parser.add_argument("--output_dir", type=Path, default=Path("."))
+    parser.add_argument("--mora", action="store_true")
+    parser.add_argument("--delta", action="store_true")
+    parser.add_argument("--frame_shift", type=float)
+    parser.add_argument("--profile-memory", action="store_true")
+    parser.add_argument("--profile", type=Path, nargs="?", const=Path("profile"))
     args = parser.parse_args()
     each(**vars(args))
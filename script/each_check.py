@@ -2,9 +2,12 @@
 アクセントの規則がおかしいものを探す。
 FIXME: つもりだったけど、ラベルファイル側の誤りが多いため、memoにあるものは無視する。
 """
+import argparse
 from pathlib import Path
+from typing import Optional
 
-from tqdm import tqdm
+from corpus import open_corpus
+from profiling import Profiler
 
 vowel_list = ("a", "i", "u", "e", "o", "A", "I", "U", "E", "O")
 pause_list = ("pau", "sil")
@@ -42,53 +45,22 @@ conso_list = (
 other_list = ("cl", "N")
 
 
-def each_check(target: str):
+def each_check(target: str, block_path: Optional[Path] = None):
+    from tqdm import tqdm
+
     print("check", target)
 
-    phoneme_list_paths = sorted((Path(target) / "phoneme").glob("*.txt"))
-    accent_start_list_paths = sorted((Path(target) / "accent_start").glob("*.txt"))
-    accent_end_list_paths = sorted((Path(target) / "accent_end").glob("*.txt"))
-    accent_phrase_start_list_paths = sorted(
-        (Path(target) / "accent_phrase_start").glob("*.txt")
-    )
-    accent_phrase_end_list_paths = sorted(
-        (Path(target) / "accent_phrase_end").glob("*.txt")
-    )
-
-    assert len(phoneme_list_paths) > 0
-    assert len(accent_start_list_paths) == len(phoneme_list_paths)
-    assert len(accent_end_list_paths) == len(phoneme_list_paths)
-    assert len(accent_phrase_start_list_paths) == len(phoneme_list_paths)
-    assert len(accent_phrase_end_list_paths) == len(phoneme_list_paths)
+    corpus = open_corpus(target, block_path=block_path, cache_size=0)
+    assert len(corpus) > 0
 
     log_path = Path("/tmp/log.txt").open("w")
 
-    for (
-        phoneme_list_path,
-        accent_start_list_path,
-        accent_end_list_path,
-        accent_phrase_start_list_path,
-        accent_phrase_end_list_path,
-    ) in tqdm(
-        zip(
-            phoneme_list_paths,
-            accent_start_list_paths,
-            accent_end_list_paths,
-            accent_phrase_start_list_paths,
-            accent_phrase_end_list_paths,
-        )
-    ):
-        phoneme = phoneme_list_path.read_text().split()
-        accent_start = [
-            bool(int(a)) for a in accent_start_list_path.read_text().split()
-        ]
-        accent_end = [bool(int(a)) for a in accent_end_list_path.read_text().split()]
-        accent_phrase_start = [
-            bool(int(a)) for a in accent_phrase_start_list_path.read_text().split()
-        ]
-        accent_phrase_end = [
-            bool(int(a)) for a in accent_phrase_end_list_path.read_text().split()
-        ]
+    for utterance in tqdm(corpus):
+        phoneme = utterance.phonemes
+        accent_start = [bool(int(a)) for a in utterance.accent_starts]
+        accent_end = [bool(int(a)) for a in utterance.accent_ends]
+        accent_phrase_start = [bool(int(a)) for a in utterance.accent_phrase_starts]
+        accent_phrase_end = [bool(int(a)) for a in utterance.accent_phrase_ends]
 
         print("\t".join(phoneme), file=log_path, flush=True)
         print("\t".join([str(int(b)) for b in accent_start]), file=log_path, flush=True)
@@ -174,6 +146,17 @@ def each_check(target: str):
         assert a == b
 
 
-for speaker, style in [["zundamon", "normal"]]:
-    target = f"{speaker}-{style}"
-    each_check(target)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--targets", nargs="+", default=["zundamon-normal"])
+    parser.add_argument("--block_path", type=Path)
+    parser.add_argument("--profile-memory", action="store_true")
+    parser.add_argument("--profile", type=Path, nargs="?", const=Path("profile"))
+    args = parser.parse_args()
+
+    profiler = Profiler(memory=args.profile_memory, cpu_dir=args.profile)
+    for target in args.targets:
+        with profiler.stage(f"check:{target}") as stage:
+            stage.utterances = len(open_corpus(target, block_path=args.block_path))
+            each_check(target, block_path=args.block_path)
+    profiler.report()
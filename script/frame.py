@@ -0,0 +1,90 @@
+"""
+ラベルファイルの時刻を使って、音素ごとのアクセント情報をフレームごとに展開したキャッシュ。
+1フレーム1バイトで、下位ビットから順にaccent_start、accent_end、accent_phrase_start、accent_phrase_endのフラグを持つ。
+話者ごとに全発話を連結した1つのファイルにし、発話ごとの開始位置とフレーム数をインデックスに書く。
+"""
+
+import mmap
+from pathlib import Path
+from typing import List, Sequence, Tuple
+
+flag_names = ["accent_start", "accent_end", "accent_phrase_start", "accent_phrase_end"]
+
+
+def frame_file_names(frame_shift: float):
+    name = f"frame_{frame_shift * 1000:g}ms"
+    return f"{name}.bin", f"{name}.tsv"
+
+
+def load_lab_times(labs_path: Path):
+    from acoustic_feature_extractor.data.phoneme import OjtPhoneme
+
+    return [(lab.start, lab.end) for lab in OjtPhoneme.load_julius_list(labs_path)]
+
+
+def pack_flags(flags_list: Sequence[Sequence[str]]):
+    # 音素ごとの"0"/"1"のフラグをビットにまとめる
+    return [
+        sum(1 << i for i, flag in enumerate(flags) if flag == "1")
+        for flags in zip(*flags_list)
+    ]
+
+
+def expand_frames(
+    packed: Sequence[int], times: Sequence[Tuple[float, float]], frame_shift: float
+):
+    assert len(packed) == len(times), (len(packed), len(times))
+    frames = bytearray(round(times[-1][1] / frame_shift))
+    for value, (start, end) in zip(packed, times):
+        s, e = round(start / frame_shift), round(end / frame_shift)
+        frames[s:e] = bytes([value]) * (e - s)
+    return bytes(frames)
+
+
+def write_frames(target_dir: Path, frame_shift: float, rows: List[Tuple[str, bytes]]):
+    bin_name, index_name = frame_file_names(frame_shift)
+    offset = 0
+    index_text = "name\toffset\tlength\n"
+    with (target_dir / bin_name).open("wb") as f:
+        for name, frames in rows:
+            f.write(frames)
+            index_text += f"{name}\t{offset}\t{len(frames)}\n"
+            offset += len(frames)
+    (target_dir / index_name).write_text(index_text)
+
+
+class FrameCache:
+    """
+    フレームごとのフラグをmmapで読む。getitemはコピーせずにmemoryviewを返す。
+    numpyを使う場合はnp.frombuffer(cache[name], dtype=np.uint8)でそのまま配列にできる。
+    """
+
+    def __init__(self, target_dir: Path, frame_shift: float):
+        bin_name, index_name = frame_file_names(frame_shift)
+        self.index = {}
+        for line in (target_dir / index_name).read_text().splitlines()[1:]:
+            name, offset, length = line.split("\t")
+            self.index[name] = (int(offset), int(length))
+
+        self.file = (target_dir / bin_name).open("rb")
+        if (target_dir / bin_name).stat().st_size == 0:
+            self.buffer = memoryview(b"")
+        else:
+            self.buffer = memoryview(
+                mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            )
+
+    def __getitem__(self, name: str):
+        offset, length = self.index[name]
+        return self.buffer[offset : offset + length]
+
+    def flags(self, name: str):
+        # フラグごとの0/1の並びに戻す
+        frames = self[name]
+        return {
+            flag_name: [(value >> i) & 1 for value in frames]
+            for i, flag_name in enumerate(flag_names)
+        }
+
+    def __len__(self):
+        return len(self.index)
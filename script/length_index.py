@@ -0,0 +1,80 @@
+"""
+音声ごとの音素数・モーラ数・アクセント句数と、全音声を連結したときの開始位置を記録したインデックス。
+学習時にデータ本体を読まずに系列長が分かるようにする。
+"""
+
+import argparse
+from dataclasses import astuple, dataclass, fields
+from pathlib import Path
+from typing import List, Sequence
+
+from mora import mora_spans
+
+
+@dataclass
+class IndexRow:
+    name: str
+    phoneme_count: int
+    mora_count: int
+    accent_phrase_count: int
+    offset: int = 0
+    mora_offset: int = 0
+
+
+def create_index_row(
+    name: str, phonemes: Sequence[str], accent_phrase_starts: Sequence[str]
+):
+    spans = mora_spans(phonemes)
+    return IndexRow(
+        name=name,
+        phoneme_count=len(phonemes),
+        mora_count=len(spans),
+        accent_phrase_count=sum(accent_phrase_starts[e - 1] == "1" for _, e in spans),
+    )
+
+
+def fill_offsets(rows: List[IndexRow]):
+    offset = mora_offset = 0
+    for row in rows:
+        row.offset = offset
+        row.mora_offset = mora_offset
+        offset += row.phoneme_count
+        mora_offset += row.mora_count
+    return rows
+
+
+def write_index(path: Path, rows: List[IndexRow]):
+    rows = fill_offsets(rows)
+    text = "\t".join(field.name for field in fields(IndexRow)) + "\n"
+    text += "".join("\t".join(map(str, astuple(row))) + "\n" for row in rows)
+    path.write_text(text)
+
+
+def load_index(path: Path):
+    lines = path.read_text().splitlines()
+    assert lines[0].split("\t") == [field.name for field in fields(IndexRow)], path
+    return [
+        IndexRow(name, *map(int, values))
+        for name, *values in (line.split("\t") for line in lines[1:])
+    ]
+
+
+def create_target_index(target_dir: Path):
+    # 書き出し済みの話者ディレクトリからインデックスを作り直す
+    rows = [
+        create_index_row(
+            path.stem,
+            path.read_text().split(),
+            (target_dir / "accent_phrase_start" / path.name).read_text().split(),
+        )
+        for path in sorted((target_dir / "phoneme").glob("*.txt"))
+    ]
+    write_index(target_dir / "index.tsv", rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("target_dirs", nargs="+", type=Path)
+    args = parser.parse_args()
+    for target_dir in args.target_dirs:
+        create_target_index(target_dir)
@@ -0,0 +1,40 @@
+from typing import List, Sequence, Tuple
+
+from data import conso_list, vowel_list
+
+
+def mora_spans(phonemes: Sequence[str]):
+    # 子音＋母音を1モーラ、それ以外（母音・撥音・促音・無音）は1音素で1モーラとする
+    spans: List[Tuple[int, int]] = []
+    i = 0
+    while i < len(phonemes):
+        if (
+            phonemes[i] in conso_list
+            and i + 1 < len(phonemes)
+            and phonemes[i + 1] in vowel_list
+        ):
+            spans.append((i, i + 2))
+            i += 2
+        else:
+            spans.append((i, i + 1))
+            i += 1
+    return spans
+
+
+def to_mora_features(
+    phonemes: Sequence[str],
+    accent_starts: Sequence[str],
+    accent_ends: Sequence[str],
+    accent_phrase_starts: Sequence[str],
+    accent_phrase_ends: Sequence[str],
+):
+    # アクセントラベルは子音と母音で同じなので、モーラの最後の音素の値を使う
+    spans = mora_spans(phonemes)
+    return (
+        ["".join(phonemes[s:e]) for s, e in spans],
+        [str(s) for s, _ in spans],
+        [accent_starts[e - 1] for _, e in spans],
+        [accent_ends[e - 1] for _, e in spans],
+        [accent_phrase_starts[e - 1] for _, e in spans],
+        [accent_phrase_ends[e - 1] for _, e in spans],
+    )
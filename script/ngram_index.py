@@ -0,0 +1,341 @@
+"""
+音素とモーラのn-gram（n≦4）から、出現する発話と位置を引く転置インデックス。
+rohan4600と各話者の出力をそれぞれ1つのセグメントにし、元のファイルが変わったセグメントだけ作り直す。
+  build: インデックスを作る・更新する
+  query: "o o"（音素）や"ko o"（モーラ）を検索し、アクセント情報と一緒に表示する
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import time
+from array import array
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from corpus import open_corpus
+from delta import base_names, delta_name
+from frame import flag_names, pack_flags
+from mora import mora_spans
+
+max_n = 4
+base_source = "rohan4600"
+kinds = ("p", "m")  # 音素、モーラ
+
+Row = Tuple[str, str, str, str, str]
+
+
+def encode_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varints(data: bytes):
+    values: List[int] = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def load_source(source: str) -> List[Tuple[str, List[Row]]]:
+    return [
+        (utterance.name, utterance.rows())
+        for utterance in open_corpus(source, cache_size=0)
+    ]
+
+
+def source_signature(source: str):
+    # ファイルの中身は読まず、書き換えられたかどうかだけを見る
+    if source == base_source:
+        paths = [Path(f"{source}_{name}.txt") for name in base_names]
+    else:
+        target_dir = Path(source)
+        paths = [target_dir, target_dir / "index.tsv", target_dir / delta_name]
+
+    h = hashlib.sha256()
+    for path in paths:
+        if path.exists():
+            stat = path.stat()
+            h.update(
+                f"{path}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}\n".encode()
+            )
+    return h.hexdigest()
+
+
+def segment_name(source: str):
+    return source.strip("/").replace("/", "__")
+
+
+def ngram_keys(phonemes: Sequence[str]) -> Iterator[Tuple[str, int]]:
+    # 位置はどちらも音素の位置にする
+    for n in range(1, max_n + 1):
+        for i in range(len(phonemes) - n + 1):
+            yield "p " + " ".join(phonemes[i : i + n]), i
+
+    spans = mora_spans(phonemes)
+    moras = ["".join(phonemes[s:e]) for s, e in spans]
+    for n in range(1, max_n + 1):
+        for i in range(len(moras) - n + 1):
+            yield "m " + " ".join(moras[i : i + n]), spans[i][0]
+
+
+def build_segment(source: str, index_dir: Path, signature: str):
+    utterances = load_source(source)
+
+    postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+    rows_text = bytearray()
+    row_offsets: List[int] = []
+    for u, (_, rows) in enumerate(utterances):
+        phonemes = [row[0] for row in rows]
+        for key, position in ngram_keys(phonemes):
+            postings[key].append((u, position))
+
+        flags = pack_flags([[row[i + 1] for row in rows] for i in range(4)])
+        row_offsets.append(len(rows_text))
+        rows_text += (
+            " ".join(phonemes) + "\t" + "".join(f"{f:x}" for f in flags)
+        ).encode()
+        rows_text += b"\n"
+
+    # 発話番号は前との差、同じ発話の中の位置も前との差で書く
+    # キーはバイト列の順に並べ、検索時に二分探索できるように各行の開始位置も書く
+    blob = bytearray()
+    keys_text = bytearray()
+    key_offsets = array("Q")
+    for key in sorted(postings, key=str.encode):
+        start = len(blob)
+        previous_u = previous_position = 0
+        for u, position in postings[key]:
+            encode_varint(u - previous_u, blob)
+            if u != previous_u:
+                previous_position = 0
+            encode_varint(position - previous_position, blob)
+            previous_u, previous_position = u, position
+
+        key_offsets.append(len(keys_text))
+        keys_text += (
+            f"{key}\t{start}\t{len(blob) - start}\t{len(postings[key])}\n".encode()
+        )
+
+    name = segment_name(source)
+    meta = {
+        "source": source,
+        "signature": signature,
+        "names": [name for name, _ in utterances],
+        "row_offsets": row_offsets,
+    }
+    index_dir.mkdir(exist_ok=True, parents=True)
+    for suffix, data in [
+        (".bin", bytes(blob)),
+        (".rows", bytes(rows_text)),
+        (".keys", bytes(keys_text)),
+        (".keyidx", key_offsets.tobytes()),
+    ]:
+        (index_dir / f"{name}{suffix}.tmp").write_bytes(data)
+        os.replace(index_dir / f"{name}{suffix}.tmp", index_dir / f"{name}{suffix}")
+
+    # メタデータを最後に置き換え、途中で止まっても次回作り直されるようにする
+    (index_dir / f"{name}.json.tmp").write_text(json.dumps(meta, ensure_ascii=False))
+    os.replace(index_dir / f"{name}.json.tmp", index_dir / f"{name}.json")
+    return len(utterances), len(key_offsets)
+
+
+def build(index_dir: Path, targets: List[str], force: bool):
+    for source in [base_source] + targets:
+        signature = source_signature(source)
+        meta_path = index_dir / f"{segment_name(source)}.json"
+        if (
+            not force
+            and meta_path.exists()
+            and json.loads(meta_path.read_text())["signature"] == signature
+        ):
+            print("skip", source)
+            continue
+
+        t = time.perf_counter()
+        num_utterances, num_keys = build_segment(source, index_dir, signature)
+        print(
+            f"build {source}: {num_utterances} utterances, {num_keys} keys "
+            f"({time.perf_counter() - t:.1f}s)"
+        )
+
+
+@dataclass
+class Match:
+    source: str
+    name: str
+    position: int
+    length: int  # 一致した音素数
+    phonemes: List[str]
+    flags: List[int]
+
+    def format(self, context: int = 3):
+        s, e = self.position, self.position + self.length
+        before = self.phonemes[max(s - context, 0) : s]
+        after = self.phonemes[e : e + context]
+        text = " ".join(before + ["["] + self.phonemes[s:e] + ["]"] + after)
+        flags = " ".join(
+            "".join(str((f >> i) & 1) for i in range(len(flag_names)))
+            for f in self.flags[s:e]
+        )
+        return f"{self.source}\t{self.name}\t{self.position}\t{text}\t{flags}"
+
+
+class NgramIndex:
+    def __init__(self, index_dir: Path):
+        self.index_dir = index_dir
+        self.metas = {
+            meta["source"]: meta
+            for meta in (
+                json.loads(path.read_text())
+                for path in sorted(index_dir.glob("*.json"))
+            )
+        }
+
+        self.files: Dict[Tuple[str, str], memoryview] = {}
+
+    def _file(self, source: str, suffix: str):
+        # 検索に使うファイルはmmapで開いておき、必要な所だけ読む
+        if (source, suffix) not in self.files:
+            path = self.index_dir / f"{segment_name(source)}{suffix}"
+            with path.open("rb") as f:
+                self.files[(source, suffix)] = (
+                    memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                    if path.stat().st_size > 0
+                    else memoryview(b"")
+                )
+        return self.files[(source, suffix)]
+
+    def _read_row(self, source: str, u: int):
+        rows = self._file(source, ".rows").obj
+        start = self.metas[source]["row_offsets"][u]
+        line = rows[start : rows.find(b"\n", start)].decode()
+        phonemes, flags = line.split("\t")
+        return phonemes.split(), [int(f, 16) for f in flags]
+
+    def _lookup(self, source: str, key: str):
+        keys = self._file(source, ".keys").obj
+        offsets = self._file(source, ".keyidx").cast("Q")
+        target = key.encode()
+
+        lo, hi = 0, len(offsets)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = offsets[mid]
+            if keys[start : keys.find(b"\t", start)] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(offsets):
+            return None
+
+        start = offsets[lo]
+        line = keys[start : keys.find(b"\n", start)].split(b"\t")
+        if line[0] != target:
+            return None
+        return int(line[1]), int(line[2]), int(line[3])
+
+    def _postings(self, source: str, key: str):
+        found = self._lookup(source, key)
+        if found is None:
+            return []
+        start, length, _ = found
+        values = decode_varints(self._file(source, ".bin")[start : start + length])
+
+        postings: List[Tuple[int, int]] = []
+        u = position = 0
+        for du, dp in zip(values[0::2], values[1::2]):
+            if du != 0:
+                position = 0
+            u += du
+            position += dp
+            postings.append((u, position))
+        return postings
+
+    def count(self, query: str, kind: str = "p"):
+        tokens = query.split()
+        assert len(tokens) <= max_n, f"count supports up to {max_n}-grams"
+        key = f"{kind} " + " ".join(tokens)
+        return {
+            source: (self._lookup(source, key) or (0, 0, 0))[2] for source in self.metas
+        }
+
+    def search(
+        self,
+        query: str,
+        kind: str = "p",
+        sources: Optional[List[str]] = None,
+        limit: Optional[int] = None,
+    ):
+        # 5-gram以上は先頭の4-gramで引き、発話の並びで確かめる
+        tokens = query.split()
+        key = f"{kind} " + " ".join(tokens[:max_n])
+
+        matches: List[Match] = []
+        for source in sources if sources is not None else list(self.metas):
+            meta = self.metas[source]
+            for u, position in self._postings(source, key):
+                phonemes, flags = self._read_row(source, u)
+                if kind == "p":
+                    length = len(tokens)
+                    found = phonemes[position : position + length] == tokens
+                else:
+                    spans = [(s, e) for s, e in mora_spans(phonemes) if s >= position][
+                        : len(tokens)
+                    ]
+                    length = spans[-1][1] - position if len(spans) > 0 else 0
+                    found = ["".join(phonemes[s:e]) for s, e in spans] == tokens
+                if not found:
+                    continue
+
+                matches.append(
+                    Match(source, meta["names"][u], position, length, phonemes, flags)
+                )
+                if limit is not None and len(matches) >= limit:
+                    return matches
+        return matches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index_dir", type=Path, default=Path("ngram_index"))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("--targets", nargs="*", default=["zundamon-normal"])
+    build_parser.add_argument("--force", action="store_true")
+
+    query_parser = subparsers.add_parser("query")
+    query_parser.add_argument("query")
+    query_parser.add_argument("--kind", choices=kinds, default="p")
+    query_parser.add_argument("--sources", nargs="+")
+    query_parser.add_argument("--limit", type=int, default=20)
+    query_parser.add_argument("--count", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build(index_dir=args.index_dir, targets=args.targets, force=args.force)
+    else:
+        t = time.perf_counter()
+        index = NgramIndex(args.index_dir)
+        if args.count:
+            for source, count in index.count(args.query, kind=args.kind).items():
+                print(source, count, sep="\t")
+        else:
+            for match in index.search(
+                args.query, kind=args.kind, sources=args.sources, limit=args.limit
+            ):
+                print(match.format())
+        print(f"{(time.perf_counter() - t) * 1000:.1f} ms")
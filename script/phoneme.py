@@ -1,15 +1,18 @@
-import multiprocessing
+import argparse
 import re
-import urllib.request
+import sys
 from difflib import SequenceMatcher, ndiff
+from itertools import repeat
 from pathlib import Path
-from typing import Union
-
-from julius4seg.sp_inserter import kata2hira
-from openjtalk_label_getter import FullContextLabel, OutputType, openjtalk_label_getter
-from tqdm import tqdm
+from typing import TYPE_CHECKING, Optional, Union
 
 from data import mora2yomi, moraend_list, pause_list, yomi2mora
+from shard import in_shard, parse_shard, write_manifest
+from transcript import default_cache_dir, load_transcript, rohan_url
+
+# 重い依存は使う関数の中でimportする
+if TYPE_CHECKING:
+    from openjtalk_label_getter import FullContextLabel
 
 
 def get_text(line: str):
@@ -18,6 +21,8 @@ def get_text(line: str):
 
 
 def get_yomi(line: str):
+    from julius4seg.sp_inserter import kata2hira
+
     katakana = line.strip().split(",")[1]
     return kata2hira(katakana)
 
@@ -37,10 +42,10 @@ def text2phoneme(text: str):
     return text.strip()
 
 
-def decide(jul_phones: list[str], ojt_labels: list[FullContextLabel], verbose=False):
+def decide(jul_phones: list[str], ojt_labels: list["FullContextLabel"], verbose=False):
     ojt_phones = [l.phoneme for l in ojt_labels]
 
-    labels: list[Union[FullContextLabel, str]] = []  # FullContextLabelが無かった場合は音素だけが入る
+    labels: list[Union["FullContextLabel", str]] = []  # FullContextLabelが無かった場合は音素だけが入る
     for tag, s1, e1, s2, e2 in SequenceMatcher(
         None, jul_phones, ojt_phones
     ).get_opcodes():
@@ -136,9 +141,7 @@ def decide(jul_phones: list[str], ojt_labels: list[FullContextLabel], verbose=Fa
     return labels
 
 
-def alignment(args: tuple[str, str], verbose=False):
-    text, yomi = args
-
+def yomi_to_jul_phones(yomi: str):
     yomi = (
         yomi.replace("？", "、")
         .replace("。", "、")
@@ -146,15 +149,26 @@ def alignment(args: tuple[str, str], verbose=False):
         .strip("、")
         .replace("、", " sp ")
     )
+    return text2phoneme(yomi).replace("q", "cl").replace("sp", "pau").split()
+
+
+def get_ojt_labels(text: str):
+    from openjtalk_label_getter import OutputType, openjtalk_label_getter
 
-    jul_phones = text2phoneme(yomi).replace("q", "cl").replace("sp", "pau").split()
-    ojt_labels = [
+    return [
         label.label
         for label in openjtalk_label_getter(
             text, output_type=OutputType.full_context_label
         )[1:-1]
     ]
 
+
+def alignment(args: tuple[str, str], verbose=False):
+    text, yomi = args
+
+    jul_phones = yomi_to_jul_phones(yomi)
+    ojt_labels = get_ojt_labels(text)
+
     labels = decide(jul_phones=jul_phones, ojt_labels=ojt_labels, verbose=verbose)
     # breakpoint()
     assert len(labels) == len(jul_phones), args
@@ -167,73 +181,185 @@ def alignment(args: tuple[str, str], verbose=False):
     return ["sil"] + labels + ["sil"]
 
 
-def label_to_phone(label: Union[FullContextLabel, str]):
+def label_to_phone(label: Union["FullContextLabel", str]):
     if isinstance(label, str):
         return label
     return label.phoneme
 
 
-# アクセント情報が書かれた読みを返す
-def make_memo(labels: list[Union[FullContextLabel, str]]):
-    memo = ""
-
-    for label in labels:
-        phone = label_to_phone(label)
-
-        if phone in pause_list:
-            memo += "|" + phone + "|"
-            continue
-
-        if phone in ["A", "I", "U", "E", "O"]:
-            phone = phone.lower()
-
-        if not isinstance(label, FullContextLabel):
-            memo += phone + "?"
-            continue
-
-        a1, a3 = (label.contexts["a1"], label.contexts["a3"])
+def _replace_moras(memo: str):
+    for mora, yomi in mora2yomi.items():
+        memo = memo.replace(mora, yomi)
+    return memo
 
-        # if a2 == "1":
-        #     memo += "|"
 
-        memo += phone
+pause2yomi = {pause: _replace_moras(pause) for pause in pause_list}
+moraend_set = set(moraend_list)
+unvoiced2voiced = {vowel: vowel.lower() for vowel in ["A", "I", "U", "E", "O"]}
+
+
+def _encode_phrase(pieces: list[str], unknown: bool):
+    # 音素と「'」の並びを、子音＋母音の表で1モーラずつかなにする
+    yomis: list[str] = []
+    consonant = ""
+    for piece in pieces:
+        if piece == "'":
+            yomis.append(piece)
+        elif piece not in moraend_set and consonant == "":
+            consonant = piece
+        else:
+            yomi = mora2yomi.get(consonant + piece)
+            if yomi is None:
+                break
+
+            # 置換を順番に適用していた頃と同じく、「ぱ」「う」は「pau」として読点になる
+            if yomi == "う" and len(yomis) > 0 and yomis[-1] == "ぱ":
+                yomis[-1] = "、"
+            else:
+                yomis.append(yomi)
+            consonant = ""
+    else:
+        if consonant == "":
+            return "".join(yomis) + ("?" if unknown else "")
 
-        if a1 == "0" and phone in moraend_list:
-            memo += "'"
+    # 表にない並びは置換を順番に適用する
+    return _replace_moras("".join(pieces)) + ("?" if unknown else "")
 
-        if a3 == "1" and phone in moraend_list:
-            memo += "|"
 
-    memo = re.sub(r"\|+", "|", memo)
-    memo = re.sub(r"^\|", "", memo)
-    memo = re.sub(r"\|$", "", memo)
+# アクセント情報が書かれた読みを返す
+def make_memo(labels: list[Union["FullContextLabel", str]]):
+    # アクセント句ごとに区切り、音素が揃ったアクセント句からかなにする
+    phrases: list[str] = []
+    pieces: list[str] = []
+    unknown = False
 
-    old_memo = memo
-    memos = []
-    for m in old_memo.split("|"):
-        if "?" in m:
-            m = m.replace("?", "")
-            m += "?"
-        memos += [m]
-    memo = "|".join(memos)
+    for label in labels:
+        is_phone = isinstance(label, str)
+        phone = label if is_phone else label.phoneme
+
+        if phone in pause2yomi:
+            if len(pieces) > 0:
+                phrases.append(_encode_phrase(pieces, unknown))
+                pieces, unknown = [], False
+            phrases.append(pause2yomi[phone])
+            continue
 
-    for mora, yomi in mora2yomi.items():
-        memo = memo.replace(mora, yomi)
+        phone = unvoiced2voiced.get(phone, phone)
+        pieces.append(phone)
 
-    # print(memo)
-    return memo
+        if is_phone:
+            unknown = True
+            continue
 
+        if phone not in moraend_set:
+            continue
 
-def main():
-    rohan_url = "https://raw.githubusercontent.com/mmorise/rohan4600/main/Rohan4600_transcript_utf8.txt"
-    with urllib.request.urlopen(rohan_url) as response:
-        rohan_string: str = response.read().decode()
+        contexts = label.contexts
 
-    output_phoneme_path = Path("rohan4600_phoneme.txt")
-    output_memo_path = Path("rohan4600_memo.txt")
+        # if contexts["a2"] == "1":
+        #     memo += "|"
 
-    texts: list[str] = list(map(get_text, rohan_string.splitlines()))
-    yomis: list[str] = list(map(get_yomi, rohan_string.splitlines()))
+        if contexts["a1"] == "0":
+            pieces.append("'")
+
+        if contexts["a3"] == "1":
+            phrases.append(_encode_phrase(pieces, unknown))
+            pieces, unknown = [], False
+
+    if len(pieces) > 0:
+        phrases.append(_encode_phrase(pieces, unknown))
+
+    return "|".join(phrases)
+
+
+def dict_alignment(args: tuple[str, str, Path]):
+    # ポーズで区切った区間ごとにアクセント句の辞書を引き、引けなかった区間だけOpenJTalkを使う
+    from accent_dict import load_accent_dict, normalize_phones, split_chunks
+
+    text, yomi, accent_dict_path = args
+    accent_dict = load_accent_dict(accent_dict_path)
+
+    jul_phones = yomi_to_jul_phones(yomi)
+    query = normalize_phones(jul_phones)
+    chunks = split_chunks(jul_phones)
+    matches = [accent_dict.match_chunk(query, s, e) for s, e in chunks]
+
+    labels = None
+    if any(matched is None for matched in matches):
+        labels = decide(jul_phones=jul_phones, ojt_labels=get_ojt_labels(text))
+        assert len(labels) == len(jul_phones), args[:2]
+
+    phones = ["sil"]
+    phrases: list[str] = []
+    position = 0
+    for (s, e), matched in zip(chunks, matches):
+        for pause in jul_phones[position:s]:
+            phones.append(pause)
+            phrases.append(pause2yomi[pause])
+
+        if matched is None:
+            phones += map(label_to_phone, labels[s:e])
+            phrases.append(make_memo(labels[s:e]))
+        else:
+            for entry in matched:
+                phones += entry.phones
+                phrases.append(entry.memo)
+        position = e
+    phones.append("sil")
+
+    return phones, "|".join(phrases), labels is not None
+
+
+def main(
+    transcript_path: Optional[Path],
+    url: str,
+    cache_dir: Path,
+    refresh: bool,
+    offline: bool,
+    sha256: Optional[str],
+    shard: Optional[tuple[int, int]],
+    output_dir: Path,
+    accent_dict_path: Optional[Path],
+    profile_memory: bool,
+    profile: Optional[Path],
+):
+    import multiprocessing
+
+    from tqdm import tqdm
+
+    from profiling import Profiler
+
+    profiler = Profiler(memory=profile_memory, cpu_dir=profile)
+
+    with profiler.stage("load_transcript"):
+        lines = load_transcript(
+            transcript_path=transcript_path,
+            url=url,
+            cache_dir=cache_dir,
+            refresh=refresh,
+            offline=offline,
+            sha256=sha256,
+        )
+
+    output_dir.mkdir(exist_ok=True, parents=True)
+    output_phoneme_path = output_dir / "rohan4600_phonemes.txt"
+    output_memo_path = output_dir / "rohan4600_memo.txt"
+
+    # シャードに含まれる行だけ処理する
+    indices = list(range(len(lines)))
+    if shard is not None:
+        indices = [i for i in indices if in_shard(lines[i].split(":")[0], shard)]
+        write_manifest(
+            output_dir,
+            kind="phoneme",
+            shard=shard,
+            total=len(lines),
+            indices=indices,
+        )
+    lines = [lines[i] for i in indices]
+
+    texts: list[str] = list(map(get_text, lines))
+    yomis: list[str] = list(map(get_yomi, lines))
 
     # texts = texts[1825:1826]
     # yomis = yomis[1825:1826]
@@ -242,21 +368,67 @@ def main():
     # ]
     # breakpoint()
 
-    with multiprocessing.Pool(processes=16) as pool:
-        it = pool.imap(alignment, zip(texts, yomis), chunksize=32)
-        labels_list = list(tqdm(it, total=len(texts)))
+    # ワーカー内のメモリ確保は計測されず、結果のlabels_listの大きさが計測される
+    if accent_dict_path is not None:
+        from accent_dict import load_accent_dict
 
-    output_phoneme_path.write_text(
-        "\n".join(" ".join(map(label_to_phone, labels)) for labels in labels_list)
-    )
+        # 先に読み込んでおき、forkしたワーカーでも使う
+        accent_dict = load_accent_dict(accent_dict_path)
+        print(f"accent dict: {len(accent_dict)} entries", file=sys.stderr)
 
-    memo = ""
-    for text, labels in zip(texts, labels_list):
-        memo += text + "\n"
-        memo += make_memo(labels[1:-1]) + "\n"
-        memo += "\n"
-    output_memo_path.write_text(memo)
+    with profiler.stage("alignment", utterances=len(texts)):
+        with multiprocessing.Pool(processes=16, **profiler.pool_kwargs()) as pool:
+            if accent_dict_path is None:
+                it = pool.imap(alignment, zip(texts, yomis), chunksize=32)
+            else:
+                it = pool.imap(
+                    dict_alignment,
+                    zip(texts, yomis, repeat(accent_dict_path)),
+                    chunksize=32,
+                )
+            results = list(tqdm(it, total=len(texts)))
+
+            # ワーカーのプロファイルを書き出させるため、terminateせずに終了させる
+            pool.close()
+            pool.join()
+
+    # 辞書を使う場合と同じ、(音素列, メモ, OpenJTalkを使ったか)の形にする
+    if accent_dict_path is None:
+        with profiler.stage("make_memo", utterances=len(texts)):
+            results = [
+                (list(map(label_to_phone, labels)), make_memo(labels[1:-1]), True)
+                for labels in results
+            ]
+    else:
+        num_ojt = sum(used_ojt for _, _, used_ojt in results)
+        print(
+            f"OpenJTalk used for {num_ojt} / {len(results)} sentences",
+            file=sys.stderr,
+        )
+
+    with profiler.stage("write", utterances=len(texts)):
+        output_phoneme_path.write_text(
+            "\n".join(" ".join(phones) for phones, _, _ in results)
+        )
+        output_memo_path.write_text(
+            "".join(f"{text}\n{memo}\n\n" for text, (_, memo, _) in zip(texts, results))
+        )
+
+    profiler.report()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--transcript_path", type=Path)
+    parser.add_argument("--url", default=rohan_url)
+    parser.add_argument("--cache_dir", type=Path, default=default_cache_dir)
+    parser.add_argument("--refresh", action="store_true")
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--sha256")
+    parser.add_argument("--shard", type=parse_shard)
+    parser.add_argument("--output_dir", type=Path, default=Path("."))
+    parser.add_argument("--accent_dict_path", type=Path)
+    parser.add_argument("--profile-memory", action="store_true")
+    parser.add_argument("--profile", type=Path, nargs="?", const=Path("profile"))
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,279 @@
+"""
+phoneme.py → (手修正) → accent_post.py → each.py → each_check.py をまとめて実行する。
+各ステージの入力ファイルのハッシュが前回と同じで、出力も残っていればスキップする。
+リポジトリのルートで実行すること。
+
+手修正済みのrohan4600_memo.txtを上書きしないよう、phoneme.pyはphoneme_output/に書き出す。
+ルートのファイルへの反映は、差分を確かめてから手で行う。
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import subprocess
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from glob import glob
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from each import dir_names
+
+script_dir = Path(__file__).parent
+
+# 既存のメモはずんだもんのもの
+each_memo_paths = {"zundamon-normal": "each_memo.txt"}
+
+rohan4600_accent_paths = [
+    "rohan4600_accent_starts.txt",
+    "rohan4600_accent_ends.txt",
+    "rohan4600_accent_phrase_starts.txt",
+    "rohan4600_accent_phrase_ends.txt",
+]
+
+phoneme_output_dir = "phoneme_output"
+
+
+def script_inputs(name: str):
+    # 実行するスクリプトと、そこから（関数の中も含めて）importしているscript/のモジュール
+    paths: List[Path] = []
+    queue = [script_dir / name]
+    while queue:
+        path = queue.pop()
+        if path in paths:
+            continue
+        paths.append(path)
+        for node in ast.walk(ast.parse(path.read_text())):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                modules = [node.module or ""]
+            else:
+                continue
+            for module in modules:
+                module_path = script_dir / f"{module.split('.')[0]}.py"
+                if module_path.exists():
+                    queue.append(module_path)
+    return sorted(str(path) for path in paths)
+
+
+@dataclass
+class Stage:
+    name: str
+    command: List[str]
+    inputs: List[str]
+    outputs: List[str]
+    deps: List[str] = field(default_factory=list)
+
+
+def each_memo_path(target: str):
+    return each_memo_paths.get(target, f"each_memo_{target}.txt")
+
+
+def script_command(name: str, *args: str):
+    return [sys.executable, str(script_dir / name), *args]
+
+
+def create_stages(
+    root_dir: Optional[Path],
+    targets: List[str],
+    phoneme: bool,
+    transcript_path: Optional[Path] = None,
+) -> List[Stage]:
+    stages: List[Stage] = []
+
+    if phoneme:
+        # ローカルの台本が無い場合はキャッシュを使い、ネットワークには出ない
+        transcript_args = (
+            ["--transcript_path", str(transcript_path)]
+            if transcript_path is not None
+            else ["--offline"]
+        )
+        stages.append(
+            Stage(
+                name="phoneme",
+                command=script_command(
+                    "phoneme.py", *transcript_args, "--output_dir", phoneme_output_dir
+                ),
+                inputs=[
+                    *([str(transcript_path)] if transcript_path is not None else []),
+                    *script_inputs("phoneme.py"),
+                ],
+                outputs=[
+                    f"{phoneme_output_dir}/rohan4600_phonemes.txt",
+                    f"{phoneme_output_dir}/rohan4600_memo.txt",
+                ],
+            )
+        )
+
+    stages.append(
+        Stage(
+            name="accent_post",
+            command=script_command("accent_post.py"),
+            inputs=[
+                "rohan4600_phonemes.txt",
+                "rohan4600_memo.txt",
+                *script_inputs("accent_post.py"),
+            ],
+            outputs=[*rohan4600_accent_paths, "rohan4600_index.tsv"],
+        )
+    )
+
+    if root_dir is None:
+        return stages
+
+    for target in targets:
+        speaker, _ = target.rsplit("-", 1)
+        memo_path = each_memo_path(target)
+        outputs = [f"{target}/{name}/*.txt" for name in dir_names]
+        outputs.append(f"{target}/index.tsv")
+
+        stages.append(
+            Stage(
+                name=f"each:{target}",
+                command=script_command(
+                    "each.py",
+                    "--root_dir",
+                    str(root_dir),
+                    "--memo_path",
+                    memo_path,
+                    "--targets",
+                    target,
+                ),
+                inputs=[
+                    "rohan4600_phonemes.txt",
+                    *rohan4600_accent_paths,
+                    str(root_dir / speaker / target / "label" / "*.lab"),
+                    memo_path,
+                    *script_inputs("each.py"),
+                ],
+                outputs=outputs,
+                deps=["accent_post"],
+            )
+        )
+        stages.append(
+            Stage(
+                name=f"each_check:{target}",
+                command=script_command("each_check.py", "--targets", target),
+                inputs=[*outputs, *script_inputs("each_check.py")],
+                outputs=[],
+                deps=[f"each:{target}"],
+            )
+        )
+
+    return stages
+
+
+def hash_files(patterns: List[str]):
+    # ファイルが無いパターンはそれ自体をハッシュに含め、存在しないことを区別する
+    h = hashlib.sha256()
+    for pattern in patterns:
+        paths = sorted(glob(pattern))
+        h.update(f"{pattern}:{len(paths)}\n".encode())
+        for path in paths:
+            h.update(path.encode())
+            h.update(hashlib.sha256(Path(path).read_bytes()).digest())
+    return h.hexdigest()
+
+
+def outputs_exist(stage: Stage):
+    return all(len(glob(pattern)) > 0 for pattern in stage.outputs)
+
+
+def run_stage(stage: Stage):
+    print("run", stage.name, flush=True)
+    return subprocess.run(stage.command).returncode
+
+
+def pipeline(
+    root_dir: Optional[Path],
+    targets: List[str],
+    phoneme: bool,
+    transcript_path: Optional[Path],
+    state_path: Path,
+    jobs: int,
+    force: bool,
+):
+    stages = create_stages(
+        root_dir=root_dir,
+        targets=targets,
+        phoneme=phoneme,
+        transcript_path=transcript_path,
+    )
+    stage_dict = {stage.name: stage for stage in stages}
+
+    state: Dict[str, Dict[str, str]] = {}
+    if state_path.exists():
+        state = json.loads(state_path.read_text())
+
+    done: Dict[str, bool] = {}  # ステージ名→実行したか
+    failed: List[str] = []
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            for stage in stages:
+                if stage.name in done or stage.name in running.values():
+                    continue
+                if any(dep not in done for dep in stage.deps if dep in stage_dict):
+                    continue
+                if failed:
+                    continue
+
+                input_hash = hash_files(stage.inputs)
+                previous = state.get(stage.name, {})
+                if (
+                    not force
+                    and previous.get("inputs") == input_hash
+                    and outputs_exist(stage)
+                    and previous.get("outputs") == hash_files(stage.outputs)
+                ):
+                    print("skip", stage.name, flush=True)
+                    done[stage.name] = False
+                    continue
+
+                running[executor.submit(run_stage, stage)] = stage.name
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = stage_dict[running.pop(future)]
+                if future.result() != 0:
+                    print("failed", stage.name, flush=True)
+                    failed.append(stage.name)
+                    continue
+
+                # 実行後の入力ハッシュを記録する（メモなど実行中に書き換わるものがあるため）
+                state[stage.name] = {
+                    "inputs": hash_files(stage.inputs),
+                    "outputs": hash_files(stage.outputs),
+                }
+                state_path.write_text(json.dumps(state, indent=2, sort_keys=True))
+                done[stage.name] = True
+
+    if done.get("phoneme"):
+        print(
+            f"phoneme outputs were written to {phoneme_output_dir}/. "
+            "review and merge them into rohan4600_memo.txt by hand",
+            flush=True,
+        )
+
+    if failed:
+        raise SystemExit(f"failed: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root_dir", type=Path)
+    parser.add_argument("--targets", nargs="+", default=["zundamon-normal"])
+    parser.add_argument("--phoneme", action="store_true")
+    parser.add_argument("--transcript_path", type=Path)
+    parser.add_argument("--state_path", type=Path, default=Path(".pipeline_state.json"))
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+    pipeline(**vars(args))
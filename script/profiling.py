@@ -0,0 +1,299 @@
+"""
+スクリプトのステージごとのメモリ使用量とCPU時間を計測する。
+計測しないときに読み込みが遅くならないよう、計測に使うモジュールは有効なときだけimportする。
+"""
+
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+@dataclass
+class MemoryStage:
+    name: str
+    utterances: Optional[int] = None
+    seconds: float = 0
+    start: int = 0  # ステージ開始時にPythonが確保しているバイト数
+    current: int = 0  # ステージ終了時にPythonが確保しているバイト数
+    peak: int = 0  # ステージ中のPythonの確保バイト数の最大値
+    max_rss: int = 0  # プロセス開始からステージ終了時点までの最大RSS（バイト）
+    top: List[str] = field(default_factory=list)
+
+
+def max_rss():
+    import resource
+
+    # Linuxではキロバイト、macOSではバイト
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class MemoryProfiler:
+    """
+    --profile-memoryのときだけ有効にする。無効なときはstageは何もしない。
+    multiprocessingのワーカー内の確保は含まれない。
+    """
+
+    def __init__(self, enabled: bool, top: int = 10):
+        self.enabled = enabled
+        self.top = top
+        self.stages: List[MemoryStage] = []
+
+        if enabled:
+            import tracemalloc
+
+            self.tracemalloc = tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def _snapshot(self):
+        # 計測自体の確保は除く
+        return self.tracemalloc.take_snapshot().filter_traces(
+            [
+                self.tracemalloc.Filter(False, self.tracemalloc.__file__),
+                self.tracemalloc.Filter(False, __file__),
+            ]
+        )
+
+    def start(self, name: str, utterances: Optional[int] = None):
+        self._stage = MemoryStage(name=name, utterances=utterances)
+        if self.enabled:
+            self._before = self._snapshot()
+            self.tracemalloc.reset_peak()
+            self._stage.start = self.tracemalloc.get_traced_memory()[0]
+            self._time = time.perf_counter()
+        return self._stage
+
+    def stop(self, utterances: Optional[int] = None):
+        stage = self._stage
+        if utterances is not None:
+            stage.utterances = utterances
+        if not self.enabled:
+            return
+
+        stage.seconds = time.perf_counter() - self._time
+        stage.current, stage.peak = self.tracemalloc.get_traced_memory()
+        stage.max_rss = max_rss()
+        stats = self._snapshot().compare_to(self._before, "lineno")
+        stage.top = [str(stat) for stat in stats[: self.top]]
+        self.stages.append(stage)
+
+    @contextmanager
+    def stage(self, name: str, utterances: Optional[int] = None):
+        # 発話数が後から分かる場合は、返り値のutterancesに代入する
+        stage = self.start(name, utterances)
+        try:
+            yield stage
+        finally:
+            self.stop()
+
+    def report(self, file=sys.stderr):
+        if not self.enabled:
+            return
+
+        for stage in self.stages:
+            text = (
+                f"[memory] {stage.name}: {stage.seconds:.1f}s, "
+                f"current {stage.current / 2**20:.1f} MiB, "
+                f"peak {stage.peak / 2**20:.1f} MiB, "
+                f"process max rss {stage.max_rss / 2**20:.1f} MiB"
+            )
+            if stage.utterances:
+                # ステージ開始時に確保済みだった分は除く
+                allocated = stage.peak - stage.start
+                text += f", {allocated / stage.utterances:.0f} bytes/utterance"
+            print(text, file=file)
+            for line in stage.top:
+                print(f"    {line}", file=file)
+
+
+def _folded_stack(frame):
+    names: List[str] = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{Path(code.co_filename).name}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """
+    CPU時間で一定間隔ごとにシグナルを受け、メインスレッドのスタックを記録する。
+    cProfileでは分からない呼び出し経路ごとの時間を、フレームグラフ用のcollapsed形式で残す。
+    setitimerの無い環境では何も記録しない。
+    """
+
+    def __init__(self, interval: float = 0.001):
+        import signal
+
+        self.signal = signal
+        self.counts: Counter[str] = Counter()
+        self.enabled = hasattr(signal, "setitimer")
+        if self.enabled:
+            self.previous = signal.signal(signal.SIGPROF, self._handle)
+            signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+    def _handle(self, signum, frame):
+        self.counts[_folded_stack(frame)] += 1
+
+    def stop(self):
+        if self.enabled:
+            self.signal.setitimer(self.signal.ITIMER_PROF, 0)
+            self.signal.signal(self.signal.SIGPROF, self.previous)
+        return self.counts
+
+
+def _write_folded(path: Path, counts: Dict[str, int]):
+    path.write_text("".join(f"{stack} {count}\n" for stack, count in counts.items()))
+
+
+def _read_folded(path: Path):
+    counts: Counter[str] = Counter()
+    for line in path.read_text().splitlines():
+        stack, count = line.rsplit(" ", 1)
+        counts[stack] += int(count)
+    return counts
+
+
+def _stage_path(output_dir: Path, name: str, suffix: str):
+    return output_dir / (name.replace(":", "_").replace("/", "_") + suffix)
+
+
+class _Recorder:
+    def __init__(self, output_dir: Path, name: str):
+        import cProfile
+
+        self.output_dir = output_dir
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler()
+        self.profile.enable()
+
+    def dump(self, suffix: str = ""):
+        self.profile.disable()
+        counts = self.sampler.stop()
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        self.profile.dump_stats(
+            _stage_path(self.output_dir, self.name, f"{suffix}.pstats")
+        )
+        _write_folded(
+            _stage_path(self.output_dir, self.name, f"{suffix}.folded"), counts
+        )
+
+
+_worker_recorder: Optional[_Recorder] = None
+
+
+def init_worker(output_dir: Path, name: str):
+    # multiprocessing.Poolのinitializer。プロセスの終了時に結果を書き出す
+    # Poolはterminateではなくclose・joinで終了させること
+    from multiprocessing.util import Finalize
+
+    global _worker_recorder
+    _worker_recorder = _Recorder(output_dir, name)
+    Finalize(
+        None, _worker_recorder.dump, args=(f".worker-{os.getpid()}",), exitpriority=10
+    )
+
+
+class CpuProfiler:
+    """
+    --profileのときだけ有効にする。ステージごとに、cProfileの結果(.pstats)と
+    スタックのサンプリング結果(.folded)をoutput_dirに書き出す。
+    pool_kwargsをmultiprocessing.Poolに渡すと、ワーカーの結果もステージの結果にまとめる。
+    """
+
+    def __init__(self, output_dir: Optional[Path], top: int = 15):
+        self.output_dir = output_dir
+        self.enabled = output_dir is not None
+        self.top = top
+        self.names: List[str] = []
+        if self.enabled:
+            import pstats
+
+            self.pstats = pstats
+
+    def start(self, name: str):
+        self._name = name
+        if self.enabled:
+            self._recorder = _Recorder(self.output_dir, name)
+
+    def pool_kwargs(self):
+        if not self.enabled:
+            return {}
+        return dict(initializer=init_worker, initargs=(self.output_dir, self._name))
+
+    def stop(self):
+        if not self.enabled:
+            return
+
+        self._recorder.dump()
+
+        # ワーカーの結果をまとめる
+        name = self._name
+        stats_path = _stage_path(self.output_dir, name, ".pstats")
+        folded_path = _stage_path(self.output_dir, name, ".folded")
+        prefix = _stage_path(self.output_dir, name, ".worker-").name
+        worker_paths = sorted(self.output_dir.glob(f"{prefix}*"))
+        if len(worker_paths) > 0:
+            stats = self.pstats.Stats(str(stats_path))
+            counts = _read_folded(folded_path)
+            for path in worker_paths:
+                if path.suffix == ".pstats":
+                    stats.add(str(path))
+                else:
+                    counts.update(_read_folded(path))
+                path.unlink()
+            stats.dump_stats(stats_path)
+            _write_folded(folded_path, counts)
+
+        self.names.append(name)
+
+    def report(self, file=sys.stderr):
+        if not self.enabled:
+            return
+
+        for name in self.names:
+            stats_path = _stage_path(self.output_dir, name, ".pstats")
+            print(f"[cpu] {name}: {stats_path}", file=file)
+            stats = self.pstats.Stats(str(stats_path), stream=file)
+            stats.sort_stats("tottime").print_stats(self.top)
+
+
+class Profiler:
+    """
+    MemoryProfilerとCpuProfilerを同じステージで使う。
+    CpuProfilerの開始・終了の処理がメモリの計測に含まれないよう、MemoryProfilerを内側にする。
+    """
+
+    def __init__(self, memory: bool, cpu_dir: Optional[Path]):
+        self.memory = MemoryProfiler(enabled=memory)
+        self.cpu = CpuProfiler(output_dir=cpu_dir)
+
+    def start(self, name: str, utterances: Optional[int] = None):
+        self.cpu.start(name)
+        return self.memory.start(name, utterances)
+
+    def stop(self, utterances: Optional[int] = None):
+        self.memory.stop(utterances)
+        self.cpu.stop()
+
+    @contextmanager
+    def stage(self, name: str, utterances: Optional[int] = None):
+        stage = self.start(name, utterances)
+        try:
+            yield stage
+        finally:
+            self.stop()
+
+    def pool_kwargs(self):
+        return self.cpu.pool_kwargs()
+
+    def report(self):
+        self.memory.report()
+        self.cpu.report()
@@ -0,0 +1,132 @@
+"""
+全話者のラベルと台本の音素列の違いを集計する。
+each.pyと同じ分類で、分類・音素の組・ファイルごとに数えて、並べ替えやすいTSVに書き出す。
+"""
+
+import argparse
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from each import classify_opcodes, normalize_phonemes
+from profiling import Profiler
+
+group_names = ["target", "stem", "category", "base", "each"]
+
+
+def diff_labels(args: Tuple[str, Path, List[str]]):
+    from acoustic_feature_extractor.data.phoneme import OjtPhoneme
+
+    target, labs_path, base_phonemes = args
+
+    labs = OjtPhoneme.load_julius_list(labs_path)
+    labs[0].phoneme = labs[-1].phoneme = "sil"
+
+    base_phoneme_list = normalize_phonemes(base_phonemes)
+    each_phoneme_list = normalize_phonemes([lab.phoneme for lab in labs])
+
+    return [
+        (
+            target,
+            labs_path.stem,
+            category,
+            " ".join(base_phoneme_list[i1:i2]) or "-",
+            " ".join(each_phoneme_list[j1:j2]) or "-",
+        )
+        for category, _, i1, i2, j1, j2 in classify_opcodes(
+            base_phoneme_list, each_phoneme_list
+        )
+        if category != "equal"
+    ]
+
+
+def find_targets(root_dir: Path):
+    return sorted(path.parent.name for path in root_dir.glob("*/*/label"))
+
+
+def report(
+    root_dir: Path,
+    targets: Optional[List[str]],
+    group_by: List[str],
+    output_path: Path,
+    num_examples: int,
+    processes: int,
+    profile: Optional[Path],
+):
+    import multiprocessing
+
+    from tqdm import tqdm
+
+    if targets is None:
+        targets = find_targets(root_dir)
+
+    base_phoneme_lists = [
+        line.split() for line in Path("rohan4600_phonemes.txt").read_text().splitlines()
+    ]
+
+    tasks: List[Tuple[str, Path, List[str]]] = []
+    for target in targets:
+        speaker, _ = target.rsplit("-", 1)
+        labs_paths = sorted((root_dir / speaker / target / "label").glob("*.lab"))
+        assert len(labs_paths) == len(base_phoneme_lists), target
+        tasks += [
+            (target, labs_path, base_phonemes)
+            for labs_path, base_phonemes in zip(labs_paths, base_phoneme_lists)
+        ]
+
+    # グループごとに、違いの数・違いのあったファイル・例を集める
+    indices = [group_names.index(name) for name in group_by]
+    counts: Counter[Tuple[str, ...]] = Counter()
+    stems: Dict[Tuple[str, ...], Set[Tuple[str, str]]] = defaultdict(set)
+    category_counts: Counter[Tuple[str, str]] = Counter()
+
+    profiler = Profiler(memory=False, cpu_dir=profile)
+    profiler.start("diff", utterances=len(tasks))
+    with multiprocessing.Pool(processes=processes, **profiler.pool_kwargs()) as pool:
+        it = pool.imap(diff_labels, tasks, chunksize=32)
+        for rows in tqdm(it, total=len(tasks)):
+            for row in rows:
+                key = tuple(row[i] for i in indices)
+                counts[key] += 1
+                stems[key].add((row[0], row[1]))
+                category_counts[(row[0], row[2])] += 1
+
+        pool.close()
+        pool.join()
+    profiler.stop()
+
+    text = "\t".join(["count", "stems"] + group_by + ["examples"]) + "\n"
+    for key, count in counts.most_common():
+        examples = sorted(stems[key])[:num_examples]
+        text += (
+            "\t".join(
+                [str(count), str(len(stems[key]))]
+                + list(key)
+                + [",".join(stem for _, stem in examples)]
+            )
+            + "\n"
+        )
+    output_path.write_text(text)
+
+    for (target, category), count in sorted(category_counts.items()):
+        print(target, category, count, sep="\t")
+
+    profiler.report()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root_dir", type=Path, required=True)
+    parser.add_argument("--targets", nargs="+")
+    parser.add_argument(
+        "--group_by",
+        nargs="+",
+        choices=group_names,
+        default=["target", "category", "base", "each"],
+    )
+    parser.add_argument("--output_path", type=Path, default=Path("report.tsv"))
+    parser.add_argument("--num_examples", type=int, default=3)
+    parser.add_argument("--processes", type=int, default=16)
+    parser.add_argument("--profile", type=Path, nargs="?", const=Path("profile"))
+    args = parser.parse_args()
+    report(**vars(args))
@@ -0,0 +1,109 @@
+"""
+長さインデックスを使って、系列長の近いものをまとめたバッチを作る。
+"""
+
+import random
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from length_index import IndexRow, load_index
+
+
+class BucketBatchSampler:
+    """
+    ランダムに選んだbucket_size個ずつを長さ順に並べてバッチに区切り、バッチの順番をシャッフルする。
+    max_tokensを指定すると、パディング込みの長さの合計がそれを超えないようにバッチを区切る。
+    """
+
+    def __init__(
+        self,
+        rows: Sequence[IndexRow],
+        batch_size: int,
+        max_tokens: Optional[int] = None,
+        bucket_size: int = 1000,
+        length: str = "phoneme_count",
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: int = 0,
+    ):
+        self.names = [row.name for row in rows]
+        self.lengths = [getattr(row, length) for row in rows]
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    @classmethod
+    def from_index_paths(cls, index_paths: Dict[str, Path], **kwargs):
+        # 複数の話者のインデックスをまとめる。名前は「ソース名/名前」にする
+        # ソース名はディレクトリから決めると、表のインデックスなどで空や..になるので指定する
+        rows: List[IndexRow] = []
+        for source, path in index_paths.items():
+            for row in load_index(path):
+                row.name = f"{source}/{row.name}"
+                rows.append(row)
+        return cls(rows, **kwargs)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _split(self, indices: List[int]):
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        max_length = 0
+        for i in indices:
+            new_max_length = max(max_length, self.lengths[i])
+            if len(batch) > 0 and (
+                len(batch) == self.batch_size
+                or (
+                    self.max_tokens is not None
+                    and new_max_length * (len(batch) + 1) > self.max_tokens
+                )
+            ):
+                batches.append(batch)
+                batch, new_max_length = [], self.lengths[i]
+            batch.append(i)
+            max_length = new_max_length
+
+        if len(batch) > 0 and not (self.drop_last and len(batch) < self.batch_size):
+            batches.append(batch)
+        return batches
+
+    def batch_indices(self):
+        rng = random.Random(self.seed + self.epoch)
+
+        indices = list(range(len(self.names)))
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        batches: List[List[int]] = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(
+                indices[start : start + self.bucket_size], key=self.lengths.__getitem__
+            )
+            batches += self._split(bucket)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def batches(self):
+        return [[self.names[i] for i in batch] for batch in self.batch_indices()]
+
+    def padding_ratio(self):
+        # パディングの割合。小さいほど良い
+        total = padded = 0
+        for batch in self.batch_indices():
+            lengths = [self.lengths[i] for i in batch]
+            total += sum(lengths)
+            padded += max(lengths) * len(lengths)
+        return 1 - total / padded
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batch_indices())
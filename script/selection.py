@@ -0,0 +1,264 @@
+"""
+候補の文からモーラバランスの良い文を選ぶ。
+読みをdata.mora_listのモーラIDに変換し、モーラとモーラの2-gramの出現数を疎行列で持ち、
+まだ足りないものを多く含む文から貪欲に選ぶ。
+"""
+
+import argparse
+import heapq
+import re
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from data import mora_list
+
+# 音素が同じモーラ（「ぐゎ」と「ぐぁ」など）は同じIDにする
+mora_names = sorted(
+    {consonant + vowel for _, consonant, vowel in mora_list if vowel != "pau"}
+)
+mora_ids = {name: i for i, name in enumerate(mora_names)}
+yomi2id = {
+    text: mora_ids[consonant + vowel]
+    for text, consonant, vowel in mora_list
+    if vowel != "pau"
+}
+
+# 伸ばし棒は手前のモーラの母音にする
+long_ids = array(
+    "i",
+    [mora_ids.get(name[-1], mora_ids[name]) for name in mora_names],
+)
+
+yomi_pattern = re.compile(
+    "|".join(re.escape(text) for text in sorted(yomi2id, key=len, reverse=True))
+    + "|ー|."
+)
+
+katakana2hiragana = str.maketrans(
+    {chr(code): chr(code - 0x60) for code in range(ord("ァ"), ord("ヶ") + 1)}
+)
+
+pause_id = -1
+
+
+def yomi_to_mora_ids(yomi: str):
+    """
+    ひらがなかカタカナの読みをモーラIDの列にする。読点やモーラにならない文字はpause_idにする。
+    rohan4600_memo.txtのアクセント記号は無視する。
+    """
+    yomi = yomi.translate(katakana2hiragana).replace("'", "").replace("|", "")
+    yomi = yomi.replace("づ", "ず").replace("ぢ", "じ").replace("を", "お")
+    yomi = yomi.replace("ゔ", "う゛").replace("ふゅ", "ひゅ").replace("しぃ", "しい")
+
+    ids = array("i")
+    for text in yomi_pattern.findall(yomi):
+        if text in yomi2id:
+            ids.append(yomi2id[text])
+        elif text == "ー" and len(ids) > 0 and ids[-1] != pause_id:
+            ids.append(long_ids[ids[-1]])
+        else:
+            ids.append(pause_id)
+    return ids
+
+
+num_features = len(mora_names) + len(mora_names) ** 2
+
+
+def mora_features(ids: array):
+    # モーラと、ポーズを挟まないモーラの2-gram
+    num = len(mora_names)
+    features = Counter(i for i in ids if i != pause_id)
+    features.update(
+        num + a * num + b
+        for a, b in zip(ids, ids[1:])
+        if a != pause_id and b != pause_id
+    )
+    return features
+
+
+class FeatureMatrix:
+    """
+    文×特徴量の出現数をCSR形式の疎行列で持つ。
+    """
+
+    def __init__(self):
+        self.indptr = array("q", [0])
+        self.indices = array("i")
+        self.counts = array("i")
+        self.lengths = array("i")
+
+    def append(self, ids: array):
+        features = mora_features(ids)
+        self.indices.extend(features.keys())
+        self.counts.extend(features.values())
+        self.indptr.append(len(self.indices))
+        self.lengths.append(sum(i != pause_id for i in ids))
+
+    def row(self, i: int):
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return zip(self.indices[start:end], self.counts[start:end])
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+class Selector:
+    """
+    特徴量ごとにcap回までの出現を数える被覆を最大化する。
+    選ぶほど増分は減るだけなので、遅延評価の貪欲法（lazy greedy）でも同じ順に選ばれる。
+    """
+
+    def __init__(
+        self,
+        matrix: FeatureMatrix,
+        cap: int,
+        bigram_weight: float,
+        per_mora: bool,
+    ):
+        self.matrix = matrix
+        self.cap = cap
+        self.per_mora = per_mora
+        self.weights = array("d", [1.0]) * len(mora_names) + array(
+            "d", [bigram_weight]
+        ) * (num_features - len(mora_names))
+        self.covered = array("i", [0]) * num_features
+
+    def add_covered(self, ids: array):
+        for feature, count in mora_features(ids).items():
+            self.covered[feature] += count
+
+    def gain(self, i: int):
+        cap, covered, weights = self.cap, self.covered, self.weights
+        gain = 0.0
+        for feature, count in self.matrix.row(i):
+            rest = cap - covered[feature]
+            if rest > 0:
+                gain += weights[feature] * (count if count < rest else rest)
+        if self.per_mora:
+            gain /= max(self.matrix.lengths[i], 1)
+        return gain
+
+    def _select(self, i: int):
+        for feature, count in self.matrix.row(i):
+            self.covered[feature] += count
+
+    def greedy(self, num: int, max_moras: Optional[int]):
+        selected: List[Tuple[int, float]] = []
+        remaining = set(range(len(self.matrix)))
+        moras = 0
+        while len(selected) < num and len(remaining) > 0:
+            gain, i = max((self.gain(i), -i) for i in remaining)
+            i = -i
+            if gain <= 0:
+                break
+            remaining.remove(i)
+            # 残りのモーラ数は減るだけなので、入らない文は以後も入らない。短い文を探し続ける
+            if max_moras is not None and moras + self.matrix.lengths[i] > max_moras:
+                continue
+            self._select(i)
+            selected.append((i, gain))
+            moras += self.matrix.lengths[i]
+        return selected
+
+    def lazy_greedy(self, num: int, max_moras: Optional[int]):
+        # ヒープには古いかもしれない増分を入れ、取り出したときに計算し直す
+        heap = [(-self.gain(i), i) for i in range(len(self.matrix))]
+        heapq.heapify(heap)
+
+        selected: List[Tuple[int, float]] = []
+        moras = 0
+        while len(selected) < num and len(heap) > 0:
+            _, i = heapq.heappop(heap)
+            gain = self.gain(i)
+            if len(heap) > 0 and (-gain, i) > heap[0]:
+                heapq.heappush(heap, (-gain, i))
+                continue
+
+            if gain <= 0:
+                break
+            if max_moras is not None and moras + self.matrix.lengths[i] > max_moras:
+                continue
+            self._select(i)
+            selected.append((i, gain))
+            moras += self.matrix.lengths[i]
+        return selected
+
+    def coverage(self):
+        num = len(mora_names)
+        return (
+            sum(c > 0 for c in self.covered[:num]),
+            sum(c > 0 for c in self.covered[num:]),
+        )
+
+
+def load_candidates(path: Path):
+    # 1行に1文。「名前<TAB>読み」か読みだけ
+    names: List[str] = []
+    yomis: List[str] = []
+    with path.open() as f:
+        for i, line in enumerate(f):
+            line = line.rstrip("\n")
+            if line.strip() == "":
+                continue
+            name, _, yomi = line.rpartition("\t")
+            names.append(name if name != "" else str(i + 1))
+            yomis.append(yomi)
+    return names, yomis
+
+
+def selection(
+    candidate_path: Path,
+    output_path: Path,
+    base_path: Optional[Path],
+    num: int,
+    max_moras: Optional[int],
+    cap: int,
+    bigram_weight: float,
+    per_mora: bool,
+    method: str,
+):
+    names, yomis = load_candidates(candidate_path)
+    matrix = FeatureMatrix()
+    for yomi in yomis:
+        matrix.append(yomi_to_mora_ids(yomi))
+
+    selector = Selector(matrix, cap=cap, bigram_weight=bigram_weight, per_mora=per_mora)
+
+    # 既にある文を足す場合は、その分を被覆済みにしておく
+    if base_path is not None:
+        for yomi in load_candidates(base_path)[1]:
+            selector.add_covered(yomi_to_mora_ids(yomi))
+
+    if method == "lazy":
+        selected = selector.lazy_greedy(num=num, max_moras=max_moras)
+    else:
+        selected = selector.greedy(num=num, max_moras=max_moras)
+
+    output_path.write_text(
+        "".join(f"{names[i]}\t{gain:.4f}\t{yomis[i]}\n" for i, gain in selected)
+    )
+
+    unigram, bigram = selector.coverage()
+    print(
+        f"selected {len(selected)} / {len(matrix)}, "
+        f"moras {sum(matrix.lengths[i] for i, _ in selected)}, "
+        f"mora coverage {unigram} / {len(mora_names)}, "
+        f"bigram coverage {bigram}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("candidate_path", type=Path)
+    parser.add_argument("--output_path", type=Path, default=Path("selected.tsv"))
+    parser.add_argument("--base_path", type=Path)
+    parser.add_argument("--num", type=int, default=100)
+    parser.add_argument("--max_moras", type=int)
+    parser.add_argument("--cap", type=int, default=1)
+    parser.add_argument("--bigram_weight", type=float, default=1.0)
+    parser.add_argument("--per_mora", action="store_true")
+    parser.add_argument("--method", choices=["lazy", "greedy"], default="lazy")
+    args = parser.parse_args()
+    selection(**vars(args))
@@ -0,0 +1,319 @@
+"""
+テキストから音素列とアクセントラベルを返すローカルサーバー。
+同時に来たリクエストはまとめてOpenJTalkのワーカーに投げる。
+
+POST /annotate {"sentences": ["テキスト", {"text": "テキスト", "yomi": "ヨミ"}, ...]}
+GET /metrics
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from accent_post import accent_check, modify_phonemes, yomi_to_phones_and_accents
+from phoneme import alignment, label_to_phone, make_memo
+
+Key = Tuple[str, Optional[str]]  # (テキスト, ヨミ)
+
+
+def annotate(text: str, yomi: Optional[str]):
+    if yomi is not None:
+        from julius4seg.sp_inserter import kata2hira
+
+        labels = alignment((text, kata2hira(yomi)))[1:-1]
+    else:
+        from openjtalk_label_getter import OutputType, openjtalk_label_getter
+
+        labels = [
+            label.label
+            for label in openjtalk_label_getter(
+                text, output_type=OutputType.full_context_label
+            )[1:-1]
+        ]
+
+    memo = make_memo(labels)
+    (
+        yomi_phones,
+        accent_starts,
+        accent_ends,
+        accent_phrase_starts,
+        accent_phrase_ends,
+    ) = yomi_to_phones_and_accents(memo)
+
+    phones = (
+        ["sil"]
+        + modify_phonemes(yomi_phones, [label_to_phone(l) for l in labels])
+        + ["sil"]
+    )
+    accent_starts = ["0"] + accent_starts + ["0"]
+    accent_ends = ["0"] + accent_ends + ["0"]
+    accent_phrase_starts = ["0"] + accent_phrase_starts + ["0"]
+    accent_phrase_ends = ["0"] + accent_phrase_ends + ["0"]
+
+    accent_check(
+        phones=phones,
+        accent_starts=[bool(int(a)) for a in accent_starts],
+        accent_ends=[bool(int(a)) for a in accent_ends],
+        accent_phrase_starts=[bool(int(a)) for a in accent_phrase_starts],
+        accent_phrase_ends=[bool(int(a)) for a in accent_phrase_ends],
+    )
+
+    return {
+        "text": text,
+        "memo": memo,
+        "phonemes": phones,
+        "accent_starts": accent_starts,
+        "accent_ends": accent_ends,
+        "accent_phrase_starts": accent_phrase_starts,
+        "accent_phrase_ends": accent_phrase_ends,
+    }
+
+
+def annotate_batch(batch: List[Key]):
+    # 1文の失敗でバッチ全体を落とさない
+    results: List[Dict[str, Any]] = []
+    for text, yomi in batch:
+        try:
+            results.append(annotate(text, yomi))
+        except Exception as e:
+            results.append({"text": text, "error": f"{type(e).__name__}: {e}"})
+    return results
+
+
+@dataclass
+class Metrics:
+    started: float = field(default_factory=time.perf_counter)
+    requests: int = 0
+    sentences: int = 0
+    cache_hits: int = 0
+    batches: int = 0
+    batched_sentences: int = 0
+    errors: int = 0
+    latencies: deque = field(default_factory=lambda: deque(maxlen=1000))
+
+    def to_dict(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float):
+            if len(latencies) == 0:
+                return None
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        uptime = time.perf_counter() - self.started
+        return {
+            "uptime": uptime,
+            "requests": self.requests,
+            "sentences": self.sentences,
+            "cache_hits": self.cache_hits,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch_size": (
+                self.batched_sentences / self.batches if self.batches > 0 else None
+            ),
+            "throughput": self.sentences / uptime,
+            "latency_ms_p50": percentile(0.5),
+            "latency_ms_p95": percentile(0.95),
+            "latency_ms_p99": percentile(0.99),
+        }
+
+
+class Service:
+    def __init__(
+        self, workers: int, max_batch_size: int, max_wait: float, cache_size: int
+    ):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+
+        self.cache: "OrderedDict[Key, Dict[str, Any]]" = OrderedDict()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.tasks: Set[asyncio.Task] = set()
+        self.metrics = Metrics()
+
+    async def batch_loop(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = asyncio.get_running_loop().time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self.run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, batch: List[Tuple[Key, asyncio.Future]]):
+        self.metrics.batches += 1
+        self.metrics.batched_sentences += len(batch)
+
+        keys = [key for key, _ in batch]
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, annotate_batch, keys
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (key, future), result in zip(batch, results):
+            if "error" not in result:
+                self.cache[key] = result
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            # クライアントが切断するとfutureはキャンセルされている
+            if not future.done():
+                future.set_result(result)
+
+    async def annotate(self, key: Key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.metrics.cache_hits += 1
+            return self.cache[key]
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((key, future))
+        return await future
+
+    async def handle_annotate(self, body: Dict[str, Any]):
+        keys: List[Key] = []
+        for sentence in body["sentences"]:
+            if isinstance(sentence, str):
+                keys.append((sentence, None))
+            else:
+                keys.append((sentence["text"], sentence.get("yomi")))
+
+        t = time.perf_counter()
+        results = await asyncio.gather(*[self.annotate(key) for key in keys])
+
+        self.metrics.requests += 1
+        self.metrics.sentences += len(keys)
+        self.metrics.errors += sum("error" in result for result in results)
+        self.metrics.latencies.append(time.perf_counter() - t)
+        return {"results": results}
+
+    async def handle(self, method: str, path: str, body: bytes):
+        try:
+            if method == "POST" and path == "/annotate":
+                return "200 OK", await self.handle_annotate(json.loads(body))
+            elif method == "GET" and path == "/metrics":
+                return "200 OK", self.metrics.to_dict()
+            else:
+                return "404 Not Found", {"error": path}
+        except (KeyError, TypeError, ValueError) as e:
+            return "400 Bad Request", {"error": str(e)}
+        except Exception as e:
+            # プロセスプールが壊れた場合なども、応答を返してから接続を続ける
+            return "500 Internal Server Error", {"error": repr(e)}
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        async def respond(status: str, response: Dict[str, Any]):
+            data = json.dumps(response, ensure_ascii=False).encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+            )
+            await writer.drain()
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                # リクエストの区切りが分からなくなるので、読めなければ応答して切断する
+                try:
+                    method, path, _ = request_line.decode().split(" ", 2)
+
+                    headers: Dict[str, str] = {}
+                    while True:
+                        line = (await reader.readline()).decode().strip()
+                        if line == "":
+                            break
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+
+                    length = int(headers.get("content-length", 0))
+                    body = await reader.readexactly(length)
+                except ValueError as e:
+                    await respond("400 Bad Request", {"error": str(e)})
+                    break
+
+                await respond(*await self.handle(method, path, body))
+
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(
+    host: str,
+    port: int,
+    unix_socket: Optional[Path],
+    workers: int,
+    max_batch_size: int,
+    max_wait_ms: float,
+    cache_size: int,
+):
+    service = Service(
+        workers=workers,
+        max_batch_size=max_batch_size,
+        max_wait=max_wait_ms / 1000,
+        cache_size=cache_size,
+    )
+
+    # ワーカーを起動しておき、最初のリクエストが遅くならないようにする
+    await asyncio.get_running_loop().run_in_executor(
+        service.executor, annotate_batch, []
+    )
+
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(
+            service.handle_connection, path=str(unix_socket)
+        )
+    else:
+        server = await asyncio.start_server(
+            service.handle_connection, host=host, port=port
+        )
+    print("serving on", ", ".join(str(s.getsockname()) for s in server.sockets))
+
+    # タスクは参照を持っておかないとGCされることがある
+    batch_task = asyncio.create_task(service.batch_loop())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+        service.executor.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=50080)
+    parser.add_argument("--unix_socket", type=Path)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_ms", type=float, default=5)
+    parser.add_argument("--cache_size", type=int, default=10000)
+    args = parser.parse_args()
+    asyncio.run(serve(**vars(args)))
@@ -0,0 +1,193 @@
+"""
+phoneme.pyとeach.pyを複数のマシンで分担して実行するためのシャード分割と、その結果のマージ。
+各シャードは出力ディレクトリにmanifest.jsonを書き出す。
+"""
+
+import argparse
+import hashlib
+import json
+import shutil
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from length_index import IndexRow, load_index, write_index
+
+manifest_name = "manifest.json"
+
+
+def parse_shard(value: str):
+    index, num = map(int, value.split("/"))
+    if not 0 <= index < num:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value}")
+    return index, num
+
+
+def shard_of(key: str, num: int):
+    # 実行環境に依存しないハッシュで振り分ける
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big") % num
+
+
+def in_shard(key: str, shard: Tuple[int, int]):
+    index, num = shard
+    return shard_of(key, num) == index
+
+
+def write_manifest(output_dir: Path, **manifest: Any):
+    output_dir.mkdir(exist_ok=True, parents=True)
+    (output_dir / manifest_name).write_text(
+        json.dumps(manifest, ensure_ascii=False, indent=2)
+    )
+
+
+def load_manifests(shard_dirs: List[Path], kind: str):
+    manifests: List[Dict[str, Any]] = []
+    for shard_dir in shard_dirs:
+        manifest = json.loads((shard_dir / manifest_name).read_text())
+        assert manifest["kind"] == kind, (shard_dir, manifest["kind"])
+        manifests.append(manifest)
+
+    nums = {manifest["shard"][1] for manifest in manifests}
+    assert len(nums) == 1, f"shard count mismatch: {nums}"
+    indices = sorted(manifest["shard"][0] for manifest in manifests)
+    assert indices == list(range(nums.pop())), f"missing shards: {indices}"
+    return manifests
+
+
+def merge_phoneme(shard_dirs: List[Path], output_dir: Path):
+    manifests = load_manifests(shard_dirs, kind="phoneme")
+
+    total = manifests[0]["total"]
+    phoneme_lines: Dict[int, str] = {}
+    memo_entries: Dict[int, str] = {}
+    for shard_dir, manifest in zip(shard_dirs, manifests):
+        assert manifest["total"] == total
+
+        phonemes = (shard_dir / "rohan4600_phonemes.txt").read_text().split("\n")
+        memo_lines = (shard_dir / "rohan4600_memo.txt").read_text().splitlines()
+        memos = [
+            "\n".join(memo_lines[i : i + 3]) + "\n"
+            for i in range(0, len(memo_lines), 3)
+        ]
+        indices = manifest["indices"]
+        if len(indices) == 0:
+            continue
+        assert len(phonemes) == len(indices) == len(memos), shard_dir
+
+        for index, phoneme, memo in zip(indices, phonemes, memos):
+            assert index not in phoneme_lines, f"duplicated: {index}"
+            phoneme_lines[index] = phoneme
+            memo_entries[index] = memo
+
+    missing = sorted(set(range(total)) - set(phoneme_lines))
+    assert len(missing) == 0, f"missing lines: {missing[:10]}"
+
+    output_dir.mkdir(exist_ok=True, parents=True)
+    (output_dir / "rohan4600_phonemes.txt").write_text(
+        "\n".join(phoneme_lines[i] for i in range(total))
+    )
+    (output_dir / "rohan4600_memo.txt").write_text(
+        "".join(memo_entries[i] for i in range(total))
+    )
+
+
+def merge_each(shard_dirs: List[Path], output_dir: Path, memo_path: Path):
+    from corpus import dir_names
+    from delta import delta_name
+    from frame import FrameCache, write_frames
+
+    manifests = load_manifests(shard_dirs, kind="each")
+
+    # 全シャードで同じ形式で書き出していること
+    delta: bool = manifests[0].get("delta", False)
+    frame_shift: Optional[float] = manifests[0].get("frame_shift")
+    for shard_dir, manifest in zip(shard_dirs, manifests):
+        assert manifest.get("delta", False) == delta, shard_dir
+        assert manifest.get("frame_shift") == frame_shift, shard_dir
+
+    memo_entries: Dict[Tuple[str, str], str] = {}
+    index_rows: Dict[str, List[IndexRow]] = {}
+    delta_lines: Dict[str, List[str]] = {}
+    frame_rows: Dict[str, List[Tuple[str, bytes]]] = {}
+    for shard_dir, manifest in zip(shard_dirs, manifests):
+        for target, target_manifest in manifest["targets"].items():
+            index_rows.setdefault(target, [])
+            index_rows[target] += load_index(shard_dir / target / "index.tsv")
+            if delta:
+                # 1行目は元の表のハッシュなので、全シャードで同じはず
+                lines = (shard_dir / target / delta_name).read_text().splitlines()
+                if target in delta_lines:
+                    assert delta_lines[target][0] == lines[0], shard_dir
+                    lines = lines[1:]
+                delta_lines.setdefault(target, []).extend(lines)
+            if frame_shift is not None:
+                cache = FrameCache(shard_dir / target, frame_shift)
+                frame_rows.setdefault(target, []).extend(
+                    (stem, bytes(cache[stem])) for stem in cache.index
+                )
+            for stem in target_manifest["written"]:
+                for dir_name in target_manifest["dir_names"]:
+                    path = Path(target) / dir_name / f"{stem}.txt"
+                    (output_dir / path.parent).mkdir(exist_ok=True, parents=True)
+                    shutil.copyfile(shard_dir / path, output_dir / path)
+
+        memo_lines = (shard_dir / manifest["memo_name"]).read_text().splitlines()
+        for i in range(0, len(memo_lines), 6):
+            target, stem = memo_lines[i].split()
+            memo_entries[(target, stem)] = "\n".join(memo_lines[i : i + 6]) + "\n"
+
+    # 全シャードで全ての音声を網羅しているか確認する
+    targets = manifests[0]["targets"].keys()
+    for target in targets:
+        stems = manifests[0]["targets"][target]["all_stems"]
+        covered: List[str] = []
+        for manifest in manifests:
+            assert manifest["targets"][target]["all_stems"] == stems
+            covered += manifest["targets"][target]["stems"]
+        assert len(covered) == len(set(covered)), f"duplicated stems: {target}"
+        missing = sorted(set(stems) - set(covered))
+        assert len(missing) == 0, f"missing stems: {target} {missing[:10]}"
+
+    for target, rows in index_rows.items():
+        # 別の形式の出力が残っているとどちらを読むべきか分からないので、マージしない
+        target_dir = output_dir / target
+        other = dir_names[0] if delta else delta_name
+        if (target_dir / other).exists():
+            raise ValueError(f"{target_dir} already has {other} of the other layout")
+
+        target_dir.mkdir(exist_ok=True, parents=True)
+        write_index(target_dir / "index.tsv", sorted(rows, key=lambda row: row.name))
+        if delta:
+            header, *lines = delta_lines[target]
+            lines.sort(key=lambda line: line.split("\t")[0])
+            (target_dir / delta_name).write_text(
+                "".join(f"{line}\n" for line in [header] + lines)
+            )
+        if frame_shift is not None:
+            write_frames(target_dir, frame_shift, sorted(frame_rows[target]))
+
+    # each.pyと同じく、対象話者の順・ファイル名順に並べる
+    order = {target: i for i, target in enumerate(targets)}
+    memo_text = "".join(
+        memo_entries[key]
+        for key in sorted(memo_entries, key=lambda key: (order[key[0]], key[1]))
+    )
+    if len(memo_text) > 0:
+        memo_path.write_text(memo_text)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    phoneme_parser = subparsers.add_parser("merge_phoneme")
+    phoneme_parser.add_argument("shard_dirs", nargs="+", type=Path)
+    phoneme_parser.add_argument("--output_dir", type=Path, default=Path("."))
+
+    each_parser = subparsers.add_parser("merge_each")
+    each_parser.add_argument("shard_dirs", nargs="+", type=Path)
+    each_parser.add_argument("--output_dir", type=Path, default=Path("."))
+    each_parser.add_argument("--memo_path", type=Path, default=Path("each_memo.txt"))
+
+    args = vars(parser.parse_args())
+    command = args.pop("command")
+    {"merge_phoneme": merge_phoneme, "merge_each": merge_each}[command](**args)
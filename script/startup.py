@@ -0,0 +1,106 @@
+"""
+スクリプトのimport時間と、multiprocessingのワーカー起動時間を計測する。
+重い依存がモジュールの読み込み時にimportされていないかの確認に使う。
+"""
+
+import argparse
+import multiprocessing
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+script_dir = Path(__file__).parent
+
+default_modules = ["data", "phoneme", "accent_post", "each", "transcript"]
+
+
+def import_time(module: str, repeat: int):
+    # 新しいプロセスでimportにかかった時間（秒）の最小値
+    code = (
+        "import time; t = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - t)"
+    )
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=script_dir,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        times.append(float(output))
+    return min(times)
+
+
+def heavy_modules(module: str):
+    # import後に読み込まれている外部パッケージ
+    code = (
+        f"import sys; import {module}; "
+        "print(' '.join(sorted({m.split('.')[0] for m in sys.modules})))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=script_dir,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    names = set(output.split())
+    return sorted(
+        names
+        & {"julius4seg", "openjtalk_label_getter", "tqdm", "acoustic_feature_extractor"}
+    )
+
+
+def _worker_initializer(module: str):
+    __import__(module)
+
+
+def _noop(x):
+    return x
+
+
+def spawn_time(module: str, repeat: int):
+    # spawnしたワーカーが最初の結果を返すまでの時間（秒）の最小値
+    context = multiprocessing.get_context("spawn")
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        with context.Pool(
+            processes=1, initializer=_worker_initializer, initargs=(module,)
+        ) as pool:
+            pool.apply(_noop, (0,))
+            times.append(time.perf_counter() - t)
+    return min(times)
+
+
+def startup(modules: List[str], repeat: int, max_ms: float):
+    sys.path.insert(0, str(script_dir))
+
+    slow = []
+    for module in modules:
+        t_import = import_time(module, repeat)
+        t_spawn = spawn_time(module, repeat)
+        heavy = heavy_modules(module)
+        print(
+            f"{module}: import {t_import * 1000:.1f} ms, "
+            f"spawn {t_spawn * 1000:.1f} ms, "
+            f"heavy {','.join(heavy) if heavy else '-'}"
+        )
+        if t_import * 1000 > max_ms or len(heavy) > 0:
+            slow.append(module)
+
+    if slow:
+        raise SystemExit(f"slow import: {', '.join(slow)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", nargs="+", default=default_modules)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max_ms", type=float, default=50)
+    args = parser.parse_args()
+    startup(**vars(args))
@@ -0,0 +1,94 @@
+"""
+台本（`ID:テキスト,ヨミ`形式）を読み込む。
+ローカルのファイルを指定しない場合はROHAN4600の台本をダウンロードしてキャッシュする。
+"""
+
+import hashlib
+from pathlib import Path
+from typing import Optional
+
+rohan_url = "https://raw.githubusercontent.com/mmorise/rohan4600/main/Rohan4600_transcript_utf8.txt"
+
+default_cache_dir = Path.home() / ".cache" / "rohan_hiho"
+
+
+def _sha256(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _download(url: str, path: Path, sha256: Optional[str]):
+    import urllib.request
+
+    with urllib.request.urlopen(url) as response:
+        data: bytes = response.read()
+
+    # 期待と違うものはキャッシュしない
+    if sha256 is not None and _sha256(data) != sha256:
+        raise ValueError(f"checksum mismatch: {url}")
+
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    tmp_path.replace(path)
+
+    checksum_path(path).write_text(_sha256(data) + "\n")
+    return data
+
+
+def checksum_path(path: Path):
+    return path.with_name(path.name + ".sha256")
+
+
+def cached_transcript(
+    url: str,
+    cache_dir: Path,
+    refresh: bool,
+    offline: bool,
+    sha256: Optional[str] = None,
+):
+    path = cache_dir / url.rsplit("/", 1)[-1]
+
+    if not refresh and path.exists() and checksum_path(path).exists():
+        data = path.read_bytes()
+        expected = sha256 or checksum_path(path).read_text().strip()
+        if _sha256(data) == expected:
+            return data
+        print(f"checksum mismatch: {path}")
+
+    if offline:
+        raise FileNotFoundError(f"valid transcript cache not found: {path}")
+
+    return _download(url, path, sha256)
+
+
+def validate_transcript(string: str):
+    lines = string.splitlines()
+    for i, line in enumerate(lines):
+        if ":" not in line or "," not in line.split(":", 1)[1]:
+            raise ValueError(f"line {i + 1} is not `ID:text,reading`: {line!r}")
+    return lines
+
+
+def load_transcript(
+    transcript_path: Optional[Path] = None,
+    url: str = rohan_url,
+    cache_dir: Path = default_cache_dir,
+    refresh: bool = False,
+    offline: bool = False,
+    sha256: Optional[str] = None,
+):
+    if transcript_path is not None:
+        data = transcript_path.read_bytes()
+        if sha256 is not None and _sha256(data) != sha256:
+            raise ValueError(f"checksum mismatch: {transcript_path}")
+    else:
+        data = cached_transcript(
+            url=url,
+            cache_dir=cache_dir,
+            refresh=refresh,
+            offline=offline,
+            sha256=sha256,
+        )
+
+    lines = [line for line in data.decode().splitlines() if line.strip() != ""]
+    return validate_transcript("\n".join(lines))
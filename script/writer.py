@@ -0,0 +1,127 @@
+"""
+話者ディレクトリへの書き出しを、裏のスレッドでまとめて行う。
+書き出し先は一時ディレクトリにしておき、最後に入れ替えることで、途中で止まっても書きかけのディレクトリが残らないようにする。
+"""
+
+import os
+import queue
+import shutil
+import threading
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+
+class StagedWriter:
+    """
+    writeは書き出しをbatch_size個ずつまとめてキューに積むだけで、すぐに返る。
+    キューが一杯のときは空くまで待つので、書き出しが追いつかなくてもメモリは増え続けない。
+    commitで全ての書き出しを待ち、target_dirを入れ替える。commitせずに終わった場合、target_dirは元のまま残る。
+    今回書き出さなかったファイルは、元のtarget_dirのものを引き継ぐ。ただしdiscardに含まれる
+    target_dir直下のファイル・ディレクトリは、別の形式の古い出力なので引き継がない。
+    """
+
+    def __init__(
+        self,
+        target_dir: Path,
+        dir_names: List[str],
+        num_workers: int = 8,
+        batch_size: int = 64,
+        max_batches: int = 16,
+        discard: Optional[List[str]] = None,
+    ):
+        self.target_dir = target_dir
+        self.staging_dir = target_dir.with_name(f".{target_dir.name}.staging")
+        self.old_dir = target_dir.with_name(f".{target_dir.name}.old")
+        self.batch_size = batch_size
+        self.discard = set(discard or [])
+
+        # 前回中断したときの一時ディレクトリは捨て、入れ替え途中なら元に戻す
+        if not self.target_dir.exists() and self.old_dir.exists():
+            self.old_dir.rename(self.target_dir)
+        if self.staging_dir.exists():
+            shutil.rmtree(self.staging_dir)
+        self.staging_dir.mkdir(parents=True)
+        for dir_name in dir_names:
+            (self.staging_dir / dir_name).mkdir()
+
+        self.written: Set[str] = set()
+        self.batch: List[Tuple[str, str]] = []
+        self.queue: "queue.Queue[Optional[List[Tuple[str, str]]]]" = queue.Queue(
+            maxsize=max_batches
+        )
+        self.errors: List[BaseException] = []
+        self.threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if len(self.errors) > 0:
+                continue
+            try:
+                for name, text in batch:
+                    (self.staging_dir / name).write_text(text)
+            except BaseException as e:
+                self.errors.append(e)
+
+    def _raise_error(self):
+        if len(self.errors) > 0:
+            raise RuntimeError(f"failed to write {self.staging_dir}") from self.errors[
+                0
+            ]
+
+    def write(self, name: str, text: str):
+        # nameはtarget_dirからの相対パス
+        self.written.add(name)
+        self.batch.append((name, text))
+        if len(self.batch) >= self.batch_size:
+            self._raise_error()
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def _join(self):
+        if len(self.batch) > 0:
+            self.queue.put(self.batch)
+            self.batch = []
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _carry_over(self):
+        if not self.target_dir.exists():
+            return
+
+        for root, _, file_names in os.walk(self.target_dir):
+            relative_dir = Path(root).relative_to(self.target_dir)
+            for file_name in file_names:
+                name = (relative_dir / file_name).as_posix()
+                path = self.staging_dir / name
+                if name in self.written or path.exists():
+                    continue
+                if name.split("/")[0] in self.discard:
+                    continue
+
+                path.parent.mkdir(exist_ok=True, parents=True)
+                try:
+                    os.link(Path(root) / file_name, path)
+                except OSError:
+                    shutil.copy2(Path(root) / file_name, path)
+
+    def commit(self):
+        self._join()
+        self._raise_error()
+        self._carry_over()
+
+        if self.old_dir.exists():
+            shutil.rmtree(self.old_dir)
+        if self.target_dir.exists():
+            self.target_dir.rename(self.old_dir)
+        self.staging_dir.rename(self.target_dir)
+        if self.old_dir.exists():
+            shutil.rmtree(self.old_dir)